@@ -16,7 +16,7 @@ from utils import netlink
 APP_NAME = 'FluidPatcher'
 POLL_TIME = 25
 
-def remote_link_request(type, body=''):
+def remote_link_request(type, body='', showerror=True):
     try:
         reply = remote.link.request(type, body)
     except:
@@ -26,7 +26,8 @@ def remote_link_request(type, body=''):
         main.remote_disconnect()
         return None
     elif reply.type == netlink.REQ_ERROR:
-        wx.MessageBox(reply.body, "Error", wx.OK|wx.ICON_ERROR)
+        if showerror:
+            wx.MessageBox(reply.body, "Error", wx.OK|wx.ICON_ERROR)
         return None
     else:
         if reply.body == '':
@@ -63,6 +64,7 @@ class SoundfontBrowser(wx.Dialog):
             style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
         self.sf = sf
         self.copypreset = ''
+        self.loaded = False
 
         self.presetlist = wx.ListCtrl(self, style=wx.LC_REPORT|wx.LC_SINGLE_SEL)
         self.presetlist.AppendColumn('Bank')
@@ -73,14 +75,17 @@ class SoundfontBrowser(wx.Dialog):
         vbox.Add(self.CreateSeparatedButtonSizer(wx.OK|wx.CANCEL), 0, wx.ALL|wx.EXPAND, 10)
         self.SetSizer(vbox)
 
+        # list the presets from the soundfont's headers, and only load it
+        # into fluidsynth once a preset is chosen to play
         if remote.link:
-            response = remote_link_request(netlink.LOAD_SOUNDFONT, sf)
+            response = remote_link_request(netlink.LIST_SFPRESETS, sf, showerror=False)
+            if response == None and remote.link:
+                response = self.load_soundfont()
             if response == None: self.EndModal(wx.CANCEL)
             for p in response:
                 self.presetlist.Append(("%03d:" % p.bank, "%03d:" % p.prog, p.name))
         else:
-            pxr.load_soundfont(sf)
-            for p in pxr.sfpresets:
+            for p in pxr.list_sfpresets(sf) or self.load_soundfont() or []:
                 self.presetlist.Append(("%03d:" % p.bank, "%03d:" % p.prog, p.name))
         
         self.presetlist.SetColumnWidth(0, wx.LIST_AUTOSIZE_USEHEADER)
@@ -97,6 +102,9 @@ class SoundfontBrowser(wx.Dialog):
             return
         self.pno = self.presetlist.GetNextSelected(-1)
         if self.pno < 0: return
+        if not self.loaded and self.load_soundfont() == None:
+            self.EndModal(wx.CANCEL)
+            return
         if remote.link:
             response = remote_link_request(netlink.SELECT_SFPRESET, self.pno)
             if response == None: self.EndModal(wx.CANCEL)
@@ -110,6 +118,17 @@ class SoundfontBrowser(wx.Dialog):
         bank, prog = [self.presetlist.GetItemText(event.GetIndex(), x).strip(':') for x in (0, 1)]
         self.copypreset = ':'.join((self.sf, bank, prog))
         
+    def load_soundfont(self):
+        if remote.link:
+            response = remote_link_request(netlink.LOAD_SOUNDFONT, self.sf)
+        elif pxr.load_soundfont(self.sf):
+            response = pxr.sfpresets
+        else:
+            wx.MessageBox("Unable to load %s" % self.sf, "Error", wx.OK|wx.ICON_ERROR)
+            response = None
+        self.loaded = response != None
+        return response
+
     def onActivate(self, event):
         self.EndModal(wx.ID_OK)
 
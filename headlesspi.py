@@ -76,6 +76,16 @@ def list_soundfonts():
     sfpaths = sorted(glob.glob(os.path.join(pxr.sfdir, '**', '*.sf2'), recursive=True), key=str.lower)
     return [os.path.relpath(x, start=pxr.sfdir) for x in sfpaths]
 
+def next_bank(inc=1):
+    banks = list_banks()
+    if not banks:
+        return pxr.currentbank
+    if pxr.currentbank in banks:
+        bno = banks.index(pxr.currentbank)
+    else:
+        bno = 0
+    return banks[(bno + inc) % len(banks)]
+
 def select_patch(n):
     pxr.select_patch(n)
     onboardled_blink(ACT_LED)
@@ -84,9 +94,13 @@ def select_patch(n):
 def load_bank(bfile):
     onboardled_set(ACT_LED, 1)
     print("Loading bank '%s' .. " % bfile, end='')
-    pxr.load_bank(bfile)
+    pxr.load_bank(bfile, background=True, progress=sfload_progress)
     onboardled_set(ACT_LED, 0)
-    print("done!")
+    print("ready!")
+
+def sfload_progress(sfont, n, total):
+    # called from the patcher's soundfont loading thread
+    print("Loaded soundfont %d/%d: %s" % (n, total, sfont))
 
 
 os.umask(0o002)
@@ -125,6 +139,7 @@ except patcher.PatcherError as e:
 
 pno = 0
 shutdowntimer = 0
+prefetched = None
 select_patch(pno)
 
 # set up the patch/bank controls
@@ -163,14 +178,8 @@ while True:
             pno = x
             select_patch(pno)
     elif 'incbank' in changed:
-        banks = list_banks()
-        if pxr.currentbank in banks:
-            bno = banks.index(pxr.currentbank)
-        else:
-            bno = 0
-        bno = (bno + changed['incbank']) % len(banks)
         try:
-            load_bank(banks[bno])
+            load_bank(next_bank(changed['incbank']))
             pno = 0
             select_patch(pno)
         except patcher.PatcherError as e:
@@ -178,6 +187,10 @@ while True:
             error_blink(3)
         else:
             pxr.write_config()    
+    elif prefetched != pxr.currentbank and not pxr.sfloading:
+        # nothing else to do - start loading the next bank's soundfonts in the background
+        prefetched = pxr.currentbank
+        pxr.prefetch_bank(next_bank())
 
 
     # check remote link for requests and process them
@@ -253,6 +266,13 @@ while True:
             else:
                 remote_link.reply(req, patcher.write_yaml(pxr.sfpresets))
         
+        elif req.type == netlink.LIST_SFPRESETS:
+            presets = pxr.list_sfpresets(req.body)
+            if not presets:
+                remote_link.reply(req, "Unable to read %s" % req.body, netlink.REQ_ERROR)
+            else:
+                remote_link.reply(req, patcher.write_yaml(presets))
+
         elif req.type == netlink.SELECT_SFPRESET:
             pno = int(req.body)
             warn = pxr.select_sfpreset(pno)
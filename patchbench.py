@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Description: patch-switch latency benchmarks for patcher
+    drives load_bank, select_patch, poll_cc and update_patch against the
+    recording stand-in for fluidwrap.Synth, so no libfluidsynth or audio
+    device is needed; reports wall time and library call counts per phase
+    for the given banks (default: all banks in the config's bankdir) and
+    for generated banks of the requested sizes; also checks that libyaml
+    (when available) parses and dumps each bank the same as pure python,
+    and that each patch's compiled router table routes the same events
+    as its rules expanded one by one, and that an effects chain reused
+    between patches ends up the same as one built fresh; also times
+    select_patch while soundfonts are loading in the background
+"""
+import os, sys, glob, time, argparse, tempfile
+from copy import deepcopy
+from collections import Counter
+
+os.environ['FLUIDWRAP_SYNTH'] = 'recorder'
+import patcher
+
+POLL_TICKS = 50
+# seconds each soundfont takes to load in check_background_loads
+SLOW_LOAD = 0.5
+# the largest first parameter of each router rule type, and the types with a second one
+ROUTER_TYPES = {'note': 127, 'cc': 127, 'prog': 127, 'pbend': 16383, 'cpress': 127, 'kpress': 127}
+ROUTER_PAR2 = ('note', 'cc', 'kpress')
+# router rules to check besides the banks' - splits, layers, fan-outs, and lists
+# that compile to fewer rules by merging, dropping duplicates, or clear/default
+ROUTER_SPECS = """
+patches:
+  all to one: {router_rules: [clear, {type: note, chan: 1-16=1-1}, {type: cc, chan: 1-16=1-1}]}
+  fan out: {router_rules: [{type: cc, chan: 1-16=3-4, par1: 1-1=1-3}]}
+  split: {router_rules: [clear, {type: note, chan: 1-1=3-3, par1: C4-G9*1+0}, {type: note, chan: 1-1=4-4, par1: C0-B3*1-12}]}
+  layer: {router_rules: [{type: note, chan: 1-1=2-6}, {type: pbend, chan: 1-1=2-6}, {type: note, chan: 1-8*1+8}]}
+  duplicates: {router_rules: [{type: cc, chan: 1-1=2-16, par1: 7-7*1+0}, {type: cc, chan: 1-1=2-16, par1: 7-7*1+0}, {type: cc}]}
+  default after: {router_rules: [{type: note, chan: 1-1=5-5}, default, {type: cc, chan: 2-2=3-3}]}
+  clear last: {router_rules: [{type: note, chan: 1-1=5-5}, clear]}
+  velocity: {router_rules: [clear, {type: note, par2: 0-127=127-127}, {type: note, chan: 1-4=5-8, par2: 1-127*0.5+64}]}
+"""
+
+class Phase:
+# accumulates wall time and library calls over the measured parts of a phase
+
+    def __init__(self, pxr, name):
+        self.pxr = pxr
+        self.name = name
+        self.ops = 0
+        self.time = 0.0
+        self.calls = Counter()
+
+    def measure(self, func, *args, ops=1):
+        self.pxr._fluid.reset_counts()
+        t = time.perf_counter()
+        func(*args)
+        self.time += time.perf_counter() - t
+        self.calls.update(self.pxr._fluid.calls)
+        self.ops += ops
+
+def run_phases(pxr, bank):
+    load = Phase(pxr, 'load_bank')
+    load.measure(pxr.load_bank, bank)
+    n = pxr.patches_count()
+
+    select = Phase(pxr, 'select_patch')
+    for i in list(range(n)) + list(reversed(range(n))):
+        select.measure(pxr.select_patch, i)
+
+    def poll(ticks):
+        for t in range(ticks):
+            pxr.poll_cc()
+
+    def sweep(ticks):
+        for t in range(ticks):
+            for link in pxr._cc_links:
+                pxr._fluid.midi_cc(link.channel - 1, link.cc, t * 127 // ticks)
+            pxr.poll_cc()
+
+    idle = Phase(pxr, 'poll_cc idle')
+    active = Phase(pxr, 'poll_cc sweep')
+    update = Phase(pxr, 'update_patch')
+    for i in range(n):
+        pxr.select_patch(i)
+        idle.measure(poll, POLL_TICKS, ops=POLL_TICKS)
+        active.measure(sweep, POLL_TICKS, ops=POLL_TICKS)
+        update.measure(pxr.update_patch, deepcopy(pxr._resolve_patch(i)))
+    return load, select, idle, active, update
+
+def generate_bank(banks, npatches):
+    templates = []
+    for b in banks:
+        templates += list(b['patches'].values())
+    bank = {k: v for k, v in banks[0].items() if k != 'patches'}
+    bank['patches'] = {}
+    for i in range(npatches):
+        patch = deepcopy(templates[i % len(templates)])
+        for channel in patch:
+            if isinstance(channel, int):
+                p = patch[channel]
+                patch[channel] = patcher.yamlext.SFPreset(p.name, p.bank, (p.prog + i) % 128)
+        bank['patches']['Patch %05d' % (i + 1)] = patch
+    return patcher.write_yaml(bank)
+
+def report(title, results):
+    print("%s" % title)
+    print("  %-14s %7s %11s %10s %10s  %s" % ('phase', 'ops', 'total ms', 'us/op', 'calls/op', 'top calls'))
+    for phase in results:
+        total = sum(phase.calls.values())
+        top = ', '.join('%s %d' % x for x in phase.calls.most_common(3))
+        print("  %-14s %7d %11.2f %10.1f %10.1f  %s" % (phase.name, phase.ops, phase.time * 1000,
+            phase.time * 1e6 / max(phase.ops, 1), total / max(phase.ops, 1), top))
+    print()
+
+def compare_yaml(title, raw):
+# parse and dump :raw with the pure-python yaml classes and with the ones yamlext uses by default,
+# check that both give the same result, and report the times
+    yamlext = patcher.yamlext
+    times = {}
+    dumps = {}
+    for name, Loader, Dumper in (('python', yamlext.oyaml.SafeLoader, yamlext.oyaml.SafeDumper),
+                                 ('default', yamlext.Loader, yamlext.Dumper)):
+        t = time.perf_counter()
+        bank = yamlext.oyaml.load(raw, Loader=Loader)
+        times[name] = time.perf_counter() - t
+        dumps[name] = yamlext.oyaml.dump(bank, Dumper=Dumper)
+    same = dumps['python'] == dumps['default']
+    print("%s: yaml parse %.2f ms python, %.2f ms %s (%s)" % (title, times['python'] * 1000,
+          times['default'] * 1000, yamlext.Loader.__name__, 'identical' if same else 'OUTPUT DIFFERS'))
+    return same
+
+def router_rules(tokens, rules):
+# the rules fluidsynth's router holds after starting with :rules and applying :tokens,
+# where 'default' stands for the default rules, which pass every event on unchanged
+    rules = list(rules)
+    for token in tokens:
+        if token == 'clear': rules = []
+        elif token == 'default': rules = ['default']
+        else: rules.append(token)
+    return rules
+
+def rule_edges(rules, n, top):
+# parameter values at and around the edges of the ranges of :rules, where routing changes
+    vals = {0, top // 2, top}
+    for rule in rules:
+        if rule != 'default' and rule[n]:
+            vals |= {rule[n][0] - 1, rule[n][0], rule[n][1], rule[n][1] + 1}
+    return sorted(val for val in vals if 0 <= val <= top)
+
+def route_event(rules, chan, par1, par2, top, nchan):
+# the set of (chan, par1, par2) events :rules send on for one event,
+# worked out the same way as fluid_midi_router_handle_midi_event
+    events = set()
+    for rule in rules:
+        if rule == 'default':
+            events.add((chan, par1, par2))
+            continue
+        vals = []
+        for val, spec, hi in zip((chan, par1, par2), rule[1:], (None, top, 127)):
+            if spec:
+                if not spec[0] <= val <= spec[1]: break
+                val = spec[3] + int(val * spec[2] + 0.5)
+                if hi != None: val = min(max(val, 0), hi)
+            vals.append(val)
+        else:
+            if 0 <= vals[0] < nchan:
+                events.add(tuple(vals))
+    return events
+
+def compare_router(title, pxr):
+# for each patch in the loaded bank, check that the compiled router table sends on the same
+# events as its rules expanded one by one on top of the default rules, for every type, channel
+# and first parameter (for pitch bends, and all second parameters, those around rule edges)
+    nchan = pxr._max_channels
+    differ = []
+    for name in pxr.patch_names():
+        patch = pxr._resolve_patch(name)
+        tokens = []
+        for rule in pxr._bank.get('router_rules', []) + patch.get('router_rules', []):
+            if rule in ('clear', 'default'): tokens.append(rule)
+            else: tokens += pxr._route_rules(**rule.__dict__)
+        expanded = router_rules(tokens, ['default'])
+        compiled = router_rules(pxr._patch_plan(name).router, [])
+        for type, top in ROUTER_TYPES.items():
+            rulesets = [[rule for rule in rules if rule == 'default' or rule[0] == type]
+                        for rules in (expanded, compiled)]
+            par1s = range(top + 1) if top == 127 else rule_edges(rulesets[0] + rulesets[1], 2, top)
+            par2s = rule_edges(rulesets[0] + rulesets[1], 3, 127) if type in ROUTER_PAR2 else [0]
+            if any(route_event(rulesets[0], chan, par1, par2, top, nchan) !=
+                   route_event(rulesets[1], chan, par1, par2, top, nchan)
+                   for chan in range(nchan) for par1 in par1s for par2 in par2s):
+                differ.append(name)
+                break
+    print("%s: compiled router tables %s" % (title, 'DIFFER: ' + ', '.join(differ) if differ else 'route the same'))
+    return not differ
+
+def fx_state(pxr):
+# the effects chain, control values and effect CC links the recorder shows
+    links = sorted((link.target, link.port, link.channel, link.cc, tuple(link.lut))
+                   for link in pxr._cc_links if link.type == 'effect')
+    return list(pxr._fluid.fxchain), dict(pxr._fluid.fxcontrols), links
+
+def compare_fxchain(title, pxr):
+# for every ordered pair of patches in the loaded bank, select the first, sweep its CC links,
+# then select the second, and check that the effects end up the same as when the second
+# patch is selected with no effects running
+    n = pxr.patches_count()
+    differ = []
+    for a in range(n):
+        for b in range(n):
+            pxr.select_patch(a)
+            for val in (0, 127, 64):
+                for link in pxr._cc_links:
+                    pxr._fluid.midi_cc(link.channel - 1, link.cc, val)
+                pxr.poll_cc()
+            pxr.select_patch(b)
+            reused = fx_state(pxr)
+            pxr.fxchain_clear()
+            pxr.select_patch(b)
+            if fx_state(pxr) != reused:
+                differ.append('%s -> %s' % (pxr.patch_name(a), pxr.patch_name(b)))
+    print("%s: reused effects chains %s" % (title, 'DIFFER: ' + ', '.join(differ) if differ else 'match fresh ones'))
+    return not differ
+
+def check_background_loads():
+# with soundfonts that are slow to load, check that selecting a patch whose soundfonts are
+# already loaded isn't held up by a background bank load or a prefetch
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for bfile, fonts in (('bank.yaml', 'abc'), ('next.yaml', 'de')):
+            with open(os.path.join(tmp, bfile), 'w') as f:
+                f.write('patches:\n' + ''.join('  %s: {1: %s.sf2:000:000}\n' % (x, x) for x in fonts))
+        pxr = patcher.Patcher()
+        pxr.cfg.update(bankdir=tmp, soundfontdir=tmp, soundfont_ram_mb=100)
+        pxr._fluid.load_delay = SLOW_LOAD
+        pxr.load_bank('bank.yaml', background=True)
+        t = time.perf_counter()
+        pxr.select_patch('a')
+        times['a background load'] = time.perf_counter() - t
+        while pxr.sfloading:
+            time.sleep(0.01)
+        pxr.prefetch_bank('next.yaml')
+        t = time.perf_counter()
+        pxr.select_patch('b')
+        times['a prefetch'] = time.perf_counter() - t
+        pxr._stop_sfloader()
+    stalled = [what for what, t in times.items() if t > SLOW_LOAD / 2]
+    print("select_patch with %.1f s soundfont loads: %s (%s)" % (SLOW_LOAD,
+          ', '.join('%.2f ms during %s' % (t * 1000, what) for what, t in times.items()),
+          'STALLS during ' + ', '.join(stalled) if stalled else 'not held up'))
+    return not stalled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].split(': ', 1)[1])
+    parser.add_argument('banks', nargs='*', help="bank files, relative to bankdir")
+    parser.add_argument('-c', '--config', default='SquishBox/squishboxconf.yaml', help="patcher config file")
+    parser.add_argument('-g', '--generate', type=int, nargs='*', default=[1000, 5000],
+                        help="sizes of generated banks (default 1000 5000)")
+    args = parser.parse_args()
+
+    pxr = patcher.Patcher(args.config)
+    bfiles = args.banks or [os.path.relpath(x, start=pxr.bankdir) for x in
+        sorted(glob.glob(os.path.join(pxr.bankdir, '**', '*.yaml'), recursive=True), key=str.lower)]
+    if not bfiles:
+        sys.exit("no banks found")
+
+    rawbanks = []
+    for bfile in bfiles:
+        f = open(os.path.join(pxr.bankdir, bfile))
+        rawbanks.append(f.read())
+        f.close()
+        compare_yaml(bfile, rawbanks[-1])
+        results = run_phases(pxr, bfile)
+        compare_router(bfile, pxr)
+        compare_fxchain(bfile, pxr)
+        report(bfile, results)
+    pxr.load_bank(ROUTER_SPECS)
+    compare_router("router specs", pxr)
+    check_background_loads()
+    print()
+
+    banks = [patcher.read_yaml(raw) for raw in rawbanks]
+    for npatches in args.generate:
+        rawbank = generate_bank(banks, npatches)
+        compare_yaml("generated bank: %d patches" % npatches, rawbank)
+        report("generated bank: %d patches" % npatches, run_phases(pxr, rawbank))
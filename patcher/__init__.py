@@ -1,13 +1,12 @@
 """
 Description: a performance-oriented patch interface for fluidsynth
 """
-import re, mido
+import os, re, time, threading, mido
 from copy import deepcopy
+from collections import namedtuple, OrderedDict
+from array import array
 from os.path import relpath, join as joinpath
-from . import yamlext, cclink, fluidwrap
-
-MAX_SF_BANK = 129
-MAX_SF_PROGRAM = 128
+from . import yamlext, cclink, fluidwrap, sf2index, bankcache, offline
 
 CC_DEFAULTS = [(7, 7, 100), (11, 11, 127), (12, 31, 0), (33, 42, 0),
                (43, 43, 127), (44, 63, 0), (65, 65, 0), (70, 79, 64),
@@ -19,8 +18,16 @@ SYNTH_DEFAULTS = {'synth.chorus.depth': 8.0, 'synth.chorus.level': 2.0,
                   'synth.reverb.room-size': 0.2, 'synth.reverb.width': 0.5,
                   'synth.gain': 0.2}
 
+SFINDEX_CACHE = '.sf2index.json'
+BANK_CACHE = '.bankcache'
+LAZY_CACHE = 64
+RENDER_BLOCK = 4096
+
 VERSION = '0.4.2'
 
+# a patch reduced to what select_patch sends to fluidsynth, with bank-level settings merged in
+PatchPlan = namedtuple('PatchPlan', 'presets cclinks effects fxchain fluidsettings router cc sysex')
+
 def read_yaml(text):
     if '---' in text:
         return yamlext.safe_load_all(text)
@@ -36,16 +43,37 @@ class PatcherError(Exception):
 
 class Patcher:
 
-    def __init__(self, cfgfile='', fluidsettings={}):
+    def __init__(self, cfgfile='', fluidsettings={}, offline=False):
         self._cfgfile = cfgfile
         self.cfg = {}
         self.read_config()
-        fluidsettings.update(self.cfg.get('fluidsettings', {}))
-        self._fluid = fluidwrap.Synth(**fluidsettings)        
+        fluidsettings = {**self.cfg.get('fluidsettings', {}), **fluidsettings}
+        self._offline = offline
+        self._fluid = fluidwrap.Synth(ccqueue=bool(self.cfg.get('cclinks_push', 0)), offline=offline, **fluidsettings)
         self._max_channels = fluidsettings.get('synth.midi-channels', 16)
         self._bank = {'patches': {'No Patches': {}}}
-        self._soundfonts = set()
+        self._patch_names = ['No Patches']
+        self._patch_indexes = {'No Patches': 0}
+        self._soundfonts = OrderedDict()
+        self._sfbrowsing = ''
+        self._sflock = threading.RLock()
+        # the soundfont a worker thread is loading without the lock held, and a condition
+        # that's notified when it's done
+        self._sfloading = None
+        self._sfloaded = threading.Condition(self._sflock)
+        self._sfloader = None
+        self._sfcancel = threading.Event()
+        self._sfprogress = None
+        self._sfindex = None
         self._cc_links = []
+        self._cctable = cclink.CCTable(self._fluid, self._max_channels)
+        self._cc_index = {}
+        self._plans = OrderedDict()
+        self._active_plan = None
+        # channels with a preset selected by the patcher (None if its soundfont was unloaded)
+        self._programs = {}
+        self._fxchain = None
+        self._fxcontrols = {}
         self.sfpresets = []
 
     @property
@@ -68,6 +96,11 @@ class Patcher:
     def currentbank(self):
         return self.cfg.get('currentbank', '')
 
+    @property
+    def sfloading(self):
+    # (loaded, total) soundfonts while a bank is loading in the background, otherwise None
+        return self._sfprogress
+
     def read_config(self):
         if self._cfgfile == '':
             return write_yaml(self.cfg)
@@ -95,8 +128,11 @@ class Patcher:
             f.write(write_yaml(self.cfg))
         f.close()
 
-    def load_bank(self, bank=None):
+    def load_bank(self, bank=None, background=False, firstpatch=0, progress=None, lazy=None):
     # load patches, settings from :bank yaml string or filename
+    # if :background, only the soundfonts used by :firstpatch are loaded before returning,
+    # the rest are loaded by a worker thread that calls :progress(soundfont, loaded, total)
+    # if :lazy (default: lazy_patches in config), patches are only constructed when used
     # returns the file contents/yaml string
         if bank == None:
             bfile = self.currentbank
@@ -109,8 +145,13 @@ class Patcher:
             self.cfg['currentbank'] = bfile
         except (OSError, FileNotFoundError):
             pass
+        if lazy == None:
+            lazy = self.cfg.get('lazy_patches', 0)
         try:
-            b = read_yaml(bank)
+            if lazy and '---' not in bank:
+                b = yamlext.lazy_load(bank, LAZY_CACHE)
+            else:
+                b = bankcache.BankCache(joinpath(self.bankdir, BANK_CACHE)).read_bank(bank, read_yaml)
         except yamlext.YAMLError:
             raise PatcherError("Unable to parse bank data")
         self._bank = b
@@ -118,9 +159,12 @@ class Patcher:
             self._bank['patches'].values()
         except:
             self._bank = {'patches': {'No Patches': {}}}
+        self._index_patches()
 
+        self._stop_sfloader()
         self._reset_synth_defaults()
         self._send_cc_defaults()
+        self._unset_untracked()
         if 'init' in self._bank:
             for opt, val in self._bank['init'].get('fluidsettings', {}).items():
                 self.fluid_set(opt, val)
@@ -129,9 +173,44 @@ class Patcher:
             for syx in self._bank['init'].get('sysex', []):
                 self._parse_sysex(syx)
 
-        self._reload_bankfonts()
+        if background:
+            try:
+                patch = self._resolve_patch(firstpatch)
+                first = {patch[channel].name for channel in patch if isinstance(channel, int)}
+            except (PatcherError, AttributeError, TypeError):
+                first = set()
+            self._reload_bankfonts(first, progress)
+        else:
+            self._reload_bankfonts()
+        self._compile_plans()
+        self._active_plan = None
         return bank
 
+    def prefetch_bank(self, bank):
+    # load the soundfonts used by :bank file in the background, as many as fit in the
+    # soundfont_ram_mb budget along with the ones in use, so a later load_bank(:bank) is quick
+    # returns True if any soundfonts will be loaded
+        budget = self.cfg.get('soundfont_ram_mb', 0) * 1024 * 1024
+        if not budget or (self._sfloader and self._sfloader.is_alive()):
+            return False
+        try:
+            f = open(joinpath(self.bankdir, bank))
+            sfneeded = self._bankfonts(read_yaml(f.read()))
+            f.close()
+        except (OSError, yamlext.YAMLError, KeyError, TypeError, AttributeError):
+            return False
+        pending = [sfont for sfont in sorted(sfneeded) if sfont not in self._soundfonts]
+        if not pending:
+            return False
+        sizes = {sfont: self._sfont_ramsize(sfont) for sfont in pending}
+        keep = self._bankfonts(self._bank) | sfneeded | {self._sfbrowsing}
+        keep |= {preset[1] for preset in self._programs.values() if preset}
+        self._stop_sfloader()
+        self._sfloader = threading.Thread(target=self._sfprefetch_worker,
+                                          args=(pending, sizes, keep, budget), daemon=True)
+        self._sfloader.start()
+        return True
+
     def save_bank(self, bankfile='', raw=''):
     # save current patches, settings in :bankfile
     # if :raw parses, save it exactly
@@ -144,6 +223,8 @@ class Patcher:
             except (yamlext.YAMLError, IOError):
                 raise PatcherError("Invalid bank data")
             self._bank = b
+            self._index_patches()
+            self._compile_plans()
             f.write(raw)
         else:
             f.write(write_yaml(self._bank))
@@ -151,157 +232,239 @@ class Patcher:
         self.cfg['currentbank'] = bankfile
 
     def patch_name(self, patch_index):
-        if patch_index >= len(self._bank['patches']):
+        if patch_index >= len(self._patch_names):
             raise PatcherError("Patch index out of range")
-        return list(self._bank['patches'])[patch_index]
+        return self._patch_names[patch_index]
         
     def patch_names(self):
-        return list(self._bank['patches'])
+        return list(self._patch_names)
         
     def patch_index(self, patch_name):
-        if patch_name not in self._bank['patches']:
+        if patch_name not in self._patch_indexes:
             raise PatcherError("Patch not found: %s" % patch_name)
-        return list(self._bank['patches']).index(patch_name)
+        return self._patch_indexes[patch_name]
 
     def patches_count(self):
-        return len(self._bank['patches'])
+        return len(self._patch_names)
 
     def select_patch(self, patch):
     # select :patch by index, name, or passing dict object
+    # only the differences from the currently active patch are sent to fluidsynth
         warnings = []
         self.sfpresets = []
-        patch = self._resolve_patch(patch)
-        
-        # select soundfont presets
-        for channel in range(1, self._max_channels + 1):
-            self._fluid.program_unset(channel - 1)
-            if channel not in patch: continue
-            preset = patch[channel]
-            if preset.name not in self._soundfonts:
-                self._reload_bankfonts()
-            if not self._fluid.program_select(channel - 1, joinpath(self.sfdir, preset.name), preset.bank, preset.prog):
-                warnings.append('Unable to select preset %s on channel %d' % (preset, channel))
+        plan = self._patch_plan(patch)
+        active = self._active_plan
+        self._active_plan = None
+
+        # select soundfont presets - only channels used by this patch or the active one are visited
+        # _programs is also updated by a prefetch thread when it unloads a soundfont, so it's
+        # only changed with _sflock held
+        targets = {preset[0]: preset for preset in plan.presets}
+        with self._sflock:
+            for channel in set(self._programs) - set(targets):
+                self._fluid.program_unset(channel - 1)
+                del self._programs[channel]
+        # presets are compared with what the synth is playing, since MIDI program changes
+        # pass through the router and can change them behind the patcher's back
+        for preset in plan.presets:
+            channel, name, bank, prog = preset
+            sfont = joinpath(self.sfdir, name)
+            if self._fluid.program_info(channel - 1) == (sfont, bank, prog):
+                with self._sflock:
+                    self._programs[channel] = preset
+                continue
+            if name not in self._soundfonts:
+                self._require_soundfont(name)
+            with self._sflock:
+                if self._fluid.program_select(channel - 1, sfont, bank, prog):
+                    self._programs[channel] = preset
+                else:
+                    self._fluid.program_unset(channel - 1)
+                    self._programs.pop(channel, None)
+                    warnings.append('Unable to select preset %s:%03d:%03d on channel %d' % (name, bank, prog, channel))
 
         # link CC messages to parameters
+        fxlinked = {(link.target, link.port) for link in self._cc_links if link.type == 'effect'}
         for type in ['effect', 'fluidsetting']:
             self.cclinks_clear(type)
-        for link in self._bank.get('cclinks', []) + patch.get('cclinks', []):
-            self.link_cc(**link.__dict__)
-
-        # activate LADSPA effects
-        self._fluid.fxchain_clear()
-        n = 1
-        for effect in self._bank.get('effects', []) + patch.get('effects', []):
-            name = 'e%s' % n
-            warn = self._fxplugin_connect(name, **effect)
-            if warn: warnings.append(warn)
-            else: n += 1
-        if n > 1: self._fluid.fxchain_activate()
-
-        # apply fluidsettings
-        for opt, val in self._bank.get('fluidsettings', {}).items():
-            self.fluid_set(opt, val)
-        for opt, val in patch.get('fluidsettings', {}).items():
-            self.fluid_set(opt, val)
+        for link in plan.cclinks:
+            self.link_cc(**dict(link))
+
+        # activate LADSPA effects - if the same plugins are already running
+        # only change the controls that differ, otherwise rebuild the chain
+        fxcontrols = self._fx_controls(plan.effects)
+        if self._fxchain != None and self._fxchain == plan.fxchain and fxlinked <= set(fxcontrols):
+            for n, effect in enumerate(plan.effects, 1):
+                for x in self._fx_labels('e%s' % n, effect.get('audioports', 'stereo')):
+                    for ctrl in effect.get('controls', []):
+                        if hasattr(ctrl, 'link'):
+                            self.link_cc(x, type='effect', **ctrl.__dict__)
+            for control, val in fxcontrols.items():
+                if control in fxlinked or self._fxcontrols.get(control) != val:
+                    self._fluid.fx_setcontrol(*control, val)
+        else:
+            self._fluid.fxchain_clear()
+            n = 1
+            for effect in plan.effects:
+                name = 'e%s' % n
+                warn = self._fxplugin_connect(name, **effect)
+                if warn: warnings.append(warn)
+                else: n += 1
+            if n > 1: self._fluid.fxchain_activate()
+            self._fxchain = plan.fxchain if n > len(plan.effects) else None
+        self._fxcontrols = fxcontrols
+
+        # apply fluidsettings - the synth drops writes that wouldn't change anything
+        for opt, val in plan.fluidsettings:
+            self._fluid.setting(opt, val)
 
         # add MIDI router rules
-        self._fluid.router_clear()
-        self._fluid.router_default()
-        for rule in self._bank.get('router_rules', []) +  patch.get('router_rules', []):
-            if rule == 'clear': self._fluid.router_clear()
-            elif rule == 'default': self._fluid.router_default()
-            else:
-                self._midi_route(**rule.__dict__)
+        if not active or plan.router != active.router:
+            self._fluid.router_clear()
+            for rule in plan.router:
+                if rule == 'default': self._fluid.router_default()
+                else: self._fluid.router_addrule(*rule)
 
         # send CC messages
-        for msg in self._bank.get('cc', []) + patch.get('cc', []):
+        for msg in plan.cc:
             if msg == 'default': self._send_cc_defaults()
-            else: self._fluid.send_cc(msg.chan - 1, msg.cc, msg.val)
+            else: self._fluid.send_cc(msg[0] - 1, msg[1], msg[2])
 
         # send SYSEX messages
-        for syx in self._bank.get('sysex', []) + patch.get('sysex', []):
+        for syx in plan.sysex:
             warn = self._parse_sysex(syx)
             if warn: warnings.append(warn)
 
+        self._active_plan = plan
         return warnings
 
     def add_patch(self, name, addlike=None):
     # new empty patch name :name, copying settings from :addlike
-        self._bank['patches'][name] = {}
+        patch = {}
         if addlike:
             addlike = self._resolve_patch(addlike)
             for x in addlike:
                 if not isinstance(x, int):
-                    self._bank['patches'][name][x] = deepcopy(addlike[x])
-        return(self._bank['patches'][name])
+                    patch[x] = deepcopy(addlike[x])
+        self._bank['patches'][name] = patch
+        self._index_patches()
+        self._plans.pop(name, None)
+        return(patch)
 
     def delete_patch(self, patch):
         if isinstance(patch, int):
-            name = list(self._bank['patches'])[patch]
+            name = self._patch_names[patch]
         else:
             name = patch
         del self._bank['patches'][name]
+        self._index_patches()
+        self._plans.pop(name, None)
         self._reload_bankfonts()
 
     def update_patch(self, patch):
     # update :patch in current bank with fluidsynth's present state
-        patch = self._resolve_patch(patch)
-        for channel in range(1, self._max_channels + 1):
-            info = self._fluid.program_info(channel - 1)
+        patch = self._resolve_patch(patch, edit=True)
+        channels = sorted(set(self._programs) | {k for k in patch if isinstance(k, int)})
+        defaults = [(cc, default) for first, last, default in CC_DEFAULTS for cc in range(first, last + 1)]
+        state = self._fluid.snapshot([channel - 1 for channel in channels], [cc for cc, _ in defaults])
+        cc_messages = []
+        for n, channel in enumerate(channels):
+            info = state.programs[n]
             if not info:
                 if channel in patch:
                     del patch[channel]
                 continue
             sfont, bank, prog = info
             patch[channel] = yamlext.SFPreset(relpath(sfont, start=self.sfdir), bank, prog)
-            cc_messages = []
-            for first, last, default in CC_DEFAULTS:
-                for cc in range(first, last + 1):
-                    val = self._fluid.get_cc(channel - 1, cc)
-                    if val != default:
-                        cc_messages.append(yamlext.CCMsg(channel, cc, val))
+            vals = state.ccs[n * len(defaults):(n + 1) * len(defaults)]
+            for (cc, default), val in zip(defaults, vals):
+                if val != default:
+                    cc_messages.append(yamlext.CCMsg(channel, cc, val))
         if cc_messages:
             patch['cc'] = cc_messages
+        self._plans = OrderedDict()
 
     def load_soundfont(self, soundfont):
     # load a single :soundfont and scan all its presets
-        for sfont in self._soundfonts - {soundfont}:
-            self._fluid.unload_soundfont(joinpath(self.sfdir, sfont))
-        if {soundfont} - self._soundfonts:
-            if not self._fluid.load_soundfont(joinpath(self.sfdir, soundfont)):
-                self._soundfonts = set()
-                return False
-        self._soundfonts = {soundfont}
+        if self._load_soundfonts({soundfont}):
+            return False
+        self._sfbrowsing = soundfont
 
-        self.sfpresets = []
-        for bank in range(MAX_SF_BANK):
-            for prog in range(MAX_SF_PROGRAM):
-                name = self._fluid.get_preset_name(joinpath(self.sfdir, soundfont), bank, prog)
-                if not name:
-                    continue
-                self.sfpresets.append(yamlext.SFPreset(name, bank, prog))
+        self.sfpresets = self.list_sfpresets(soundfont) or \
+            [yamlext.PresetRecord(*p) for p in self._fluid.get_presets(joinpath(self.sfdir, soundfont))]
         if not self.sfpresets: return False
-        for channel in range(0, self._max_channels):
-            self._fluid.program_unset(channel)
+        with self._sflock:
+            for channel in range(self._max_channels):
+                self._fluid.program_unset(channel)
+            self._programs = {}
         self._fluid.router_clear()
         self._fluid.router_default()
         self._fluid.fxchain_clear()
+        self._fxchain = None
         self._reset_synth_defaults()
         self._send_cc_defaults()
         self._midi_route('note', chan=yamlext.FromToSpec(2, self._max_channels, 0, 0))
+        self._active_plan = None
         return True
         
+    def list_sfpresets(self, soundfont):
+    # list the presets in :soundfont by reading its headers, without loading it
+        try:
+            index = self._sfindex_cache().read_index(soundfont)
+        except (OSError, sf2index.SF2Error):
+            return []
+        return [yamlext.PresetRecord(p.name, p.bank, p.prog) for p in index.presets]
+
     def select_sfpreset(self, presetnum):
         warnings = []
         if presetnum < len(self.sfpresets):
             p = self.sfpresets[presetnum]
-            soundfont = list(self._soundfonts)[0]
-            if not self._fluid.program_select(0, joinpath(self.sfdir, soundfont), p.bank, p.prog):
-                warnings.append('Unable to select preset %s' % p)
+            with self._sflock:
+                if self._fluid.program_select(0, joinpath(self.sfdir, self._sfbrowsing), p.bank, p.prog):
+                    self._programs[1] = (1, self._sfbrowsing, p.bank, p.prog)
+                else:
+                    warnings.append('Unable to select preset %s' % (p,))
         else:
             warnings.append('Preset out of range')
         return warnings
 
+    def render(self, source, wavfile='', patch=None, tail=2.0, block=RENDER_BLOCK, blockfunc=None):
+    # play the MIDI messages in :source through :patch (or the present state) as fast
+    # as possible, and return the audio - only for Patchers created with offline=True
+    # audio is synthesized at most :block frames at a time, and :blockfunc is called
+    # after each block with the number of frames and the seconds it took
+        if not self._offline:
+            raise PatcherError("Rendering needs a Patcher created with offline=True")
+        if patch != None:
+            self.select_patch(patch)
+        rate = self.fluid_get('synth.sample-rate')
+        audio = array('f')
+        frame = 0
+        for t, *event in offline.midi_events(source):
+            frame = self._render_frames(audio, frame, round(t * rate), block, blockfunc)
+            self._fluid.send_event(*event)
+            self.poll_cc()
+        self._render_frames(audio, frame, frame + round(tail * rate), block, blockfunc)
+        if wavfile:
+            offline.write_wav(wavfile, audio, rate)
+        return audio
+
+    def active_voices(self):
+        return self._fluid.active_voices()
+
+    def fxchain_clear(self):
+    # remove the LADSPA effects and effect CC links set up by the selected patch,
+    # which get set up again the next time a patch with effects is selected
+    # returns True if there were any effects
+        effects = self._active_plan != None and bool(self._active_plan.effects)
+        self._fluid.fxchain_clear()
+        self._fxchain = None
+        self._fxcontrols = {}
+        self.cclinks_clear('effect')
+        if self._active_plan:
+            self._active_plan = self._active_plan._replace(effects=(), fxchain=())
+        return effects
+
     def fluid_get(self, opt):
         return self._fluid.get_setting(opt)
 
@@ -310,9 +473,10 @@ class Patcher:
         if updatebank:
             self._bank['fluidsettings'][opt] = val
             if patch:
-                patch = self._resolve_patch(patch)
+                patch = self._resolve_patch(patch, edit=True)
                 if opt in patch.get('fluidsettings', {}):
                     patch['fluidsettings'].remove(opt)
+            self._plans = OrderedDict()
 
     def link_cc(self, target, link='', type='fluidsetting', xfrm=yamlext.RouterSpec(0, 127, 1, 0), **kwargs):
         if 'chan' in kwargs:
@@ -324,20 +488,37 @@ class Patcher:
                 raise PatcherError("Badly formatted xfrm for CCLink")
         if isinstance(xfrm, yamlext.FromToSpec):
             xfrm = yamlext.RouterSpec.fromtospec(xfrm)        
-        self._cc_links.append(cclink.CCLink(self._fluid, target, link, type, xfrm, **kwargs))
+        link = cclink.CCLink(self._cctable, target, link, type, xfrm, **kwargs)
+        if type == 'fluidsetting':
+            link.action = self._fluid.setting_setter(target)
+        elif type == 'effect':
+            link.action = self._fluid.fx_setter(target, link.port)
+        self._cc_links.append(link)
+        self._index_cclinks()
                 
     def poll_cc(self):
         retvals = {}
-        for link in self._cc_links:
-            if link.haschanged():
-                if link.xfrm.min <= link.val <= link.xfrm.max:
-                    val = link.val * link.xfrm.mul + link.xfrm.add
-                    if link.type == 'fluidsetting':
-                        self.fluid_set(link.target, val)
-                    elif link.type == 'effect':
-                        self._fluid.fx_setcontrol(link.target, link.port, val)
-                    else:
-                        retvals[link.target] = val
+        if self._fluid.ccqueue != None:
+            # push mode - only check links whose CC has received messages
+            changed = {}
+            queue = self._fluid.ccqueue
+            while queue:
+                index = self._cctable.update(*queue.popleft())
+                if index != None:
+                    changed[index] = True
+            links = [link for index in changed for link in self._cc_index.get(index, [])]
+        else:
+            self._cctable.refresh()
+            links = self._cc_links
+        for link in links:
+            if link.haschanged(self._cctable):
+                val = link.lut[link.val]
+                if val == None:
+                    continue
+                if link.action:
+                    link.action(val)
+                else:
+                    retvals[link.target] = val
         return retvals
         
     def cclinks_clear(self, type=''):
@@ -345,34 +526,214 @@ class Patcher:
             self._cc_links = [link for link in self._cc_links if link.type != type]
         else:
             self._cc_links = []
+        self._index_cclinks()
         
     # private functions
-    def _reload_bankfonts(self):
+    def _index_cclinks(self):
+        self._cctable.watch(self._cc_links)
+        self._cc_index = {}
+        for link in self._cc_links:
+            self._cc_index.setdefault(link.index, []).append(link)
+
+    def _index_patches(self):
+        self._patch_names = list(self._bank['patches'])
+        self._patch_indexes = {name: i for i, name in enumerate(self._patch_names)}
+
+    def _compile_plans(self):
+        self._plans = OrderedDict()
+        if isinstance(self._bank['patches'], yamlext.LazyPatches):
+            return # compiled as they're selected
+        for name, patch in self._bank['patches'].items():
+            try:
+                self._plans[name] = self._compile_patch(patch)
+            except (AttributeError, TypeError):
+                pass # malformed patches are reported when selected
+
+    def _patch_plan(self, patch):
+        if isinstance(patch, (int, str)):
+            if isinstance(patch, int):
+                if patch < 0 or patch >= len(self._patch_names):
+                    raise PatcherError("Patch index out of range")
+                name = self._patch_names[patch]
+            else:
+                name = patch
+            if name not in self._plans:
+                if isinstance(self._bank['patches'], yamlext.LazyPatches) and len(self._plans) >= LAZY_CACHE:
+                    self._plans.popitem(last=False)
+                self._plans[name] = self._compile_patch(self._resolve_patch(name))
+            self._plans.move_to_end(name)
+            return self._plans[name]
+        return self._compile_patch(patch)
+
+    def _compile_patch(self, patch):
+        presets = tuple((channel, patch[channel].name, patch[channel].bank, patch[channel].prog)
+                        for channel in sorted(x for x in patch if isinstance(x, int)))
+        cclinks = tuple(tuple(link.__dict__.items())
+                        for link in self._bank.get('cclinks', []) + patch.get('cclinks', []))
+        effects = tuple(self._bank.get('effects', []) + patch.get('effects', []))
+        fxchain = tuple(self._fx_fingerprint(**effect) for effect in effects)
+        fluidsettings = {}
+        fluidsettings.update(self._bank.get('fluidsettings', {}))
+        fluidsettings.update(patch.get('fluidsettings', {}))
+        router = []
+        for rule in self._bank.get('router_rules', []) + patch.get('router_rules', []):
+            if rule in ('clear', 'default'): router.append(rule)
+            else: router += self._route_rules(**rule.__dict__)
+        router = self._compile_router(router)
+        cc = tuple(msg if msg == 'default' else (msg.chan, msg.cc, msg.val)
+                   for msg in self._bank.get('cc', []) + patch.get('cc', []))
+        sysex = tuple(self._bank.get('sysex', []) + patch.get('sysex', []))
+        return PatchPlan(presets, cclinks, effects, fxchain, tuple(fluidsettings.items()),
+                         router, cc, sysex)
+
+    def _reload_bankfonts(self, first=None, progress=None):
+        self._load_soundfonts(self._bankfonts(self._bank), first, progress)
+
+    def _bankfonts(self, bank):
+        if isinstance(bank['patches'], yamlext.LazyPatches):
+            return bank['patches'].soundfonts()
         sfneeded = set()
-        for patch in self._bank['patches'].values():
+        for patch in bank['patches'].values():
             for channel in patch:
                 if isinstance(channel, int):
                     sfneeded |= {patch[channel].name}
-        missing = set()
-        for sfont in self._soundfonts - sfneeded:
-            self._fluid.unload_soundfont(joinpath(self.sfdir, sfont))
-        for sfont in sfneeded - self._soundfonts:
+        return sfneeded
+
+    def _load_soundfonts(self, sfneeded, first=None, progress=None):
+    # make sure the :sfneeded soundfonts are loaded, and keep other recently used
+    # soundfonts loaded as long as the total fits in the soundfont_ram_mb budget
+    # if :first is given, only those are loaded now and the rest in the background
+    # returns the set of soundfonts that couldn't be loaded
+        self._stop_sfloader()
+        with self._sflock:
+            budget = self.cfg.get('soundfont_ram_mb', 0) * 1024 * 1024
+            sizes = {sfont: self._soundfonts.get(sfont) or self._sfont_ramsize(sfont) for sfont in sfneeded}
+            total = sum(sizes.values()) + sum(size for sfont, size in self._soundfonts.items() if sfont not in sfneeded)
+            for sfont in list(self._soundfonts):
+                if total <= budget: break
+                if sfont in sfneeded: continue
+                total -= self._soundfonts[sfont]
+                self._unload_soundfont(sfont)
+            missing = set()
+            for sfont in sorted(sfneeded if first == None else sfneeded & first):
+                if not self._sfload(sfont, sizes[sfont]):
+                    missing.add(sfont)
+        if first != None:
+            pending = [sfont for sfont in sorted(sfneeded - first) if sfont not in self._soundfonts]
+            if pending:
+                self._sfprogress = 0, len(pending)
+                self._sfloader = threading.Thread(target=self._sfload_worker,
+                                                  args=(pending, sizes, progress), daemon=True)
+                self._sfloader.start()
+        return missing
+
+    def _sfload(self, sfont, size):
+        if sfont not in self._soundfonts:
             if not self._fluid.load_soundfont(joinpath(self.sfdir, sfont)):
-                missing |= {sfont}
-        self._soundfonts = sfneeded - missing
+                return False
+            self._soundfonts[sfont] = size
+        self._soundfonts.move_to_end(sfont)
+        return True
 
-    def _resolve_patch(self, patch):
+    def _sfload_unlocked(self, sfont, size):
+    # load :sfont from a worker thread, holding _sflock only to update the bookkeeping, so
+    # select_patch isn't held up while the file is read; returns True if it was newly loaded
+        with self._sflock:
+            if sfont in self._soundfonts: return False
+            self._sfloading = sfont
+        loaded = self._fluid.load_soundfont(joinpath(self.sfdir, sfont))
+        with self._sflock:
+            if loaded: self._soundfonts[sfont] = size
+            self._sfloading = None
+            self._sfloaded.notify_all()
+        return loaded
+
+    def _sfload_worker(self, pending, sizes, progress):
+        for n, sfont in enumerate(pending, 1):
+            if self._sfcancel.is_set(): break
+            if not self._sfload_unlocked(sfont, sizes[sfont]):
+                with self._sflock:
+                    if sfont in self._soundfonts: self._soundfonts.move_to_end(sfont)
+            if self._sfcancel.is_set(): break
+            self._sfprogress = n, len(pending)
+            if progress: progress(sfont, n, len(pending))
+        self._sfprogress = None
+
+    def _sfprefetch_worker(self, pending, sizes, keep, budget):
+    # prefetched soundfonts go in as least recently used, so they're the first to go
+    # if the bank they were fetched for isn't loaded after all
+        for sfont in pending:
+            if self._sfcancel.is_set(): break
+            with self._sflock:
+                total = sum(self._soundfonts.values()) + sizes[sfont]
+                for old in list(self._soundfonts):
+                    if total <= budget: break
+                    if old in keep: continue
+                    total -= self._soundfonts[old]
+                    self._unload_soundfont(old)
+                if total > budget: break
+            if self._sfload_unlocked(sfont, sizes[sfont]):
+                with self._sflock:
+                    self._soundfonts.move_to_end(sfont, last=False)
+
+    def _stop_sfloader(self):
+        if self._sfloader:
+            self._sfcancel.set()
+            self._sfloader.join()
+            self._sfcancel.clear()
+            self._sfloader = None
+            self._sfprogress = None
+
+    def _require_soundfont(self, sfont):
+    # a patch needs :sfont right now - if the bank is still loading, load it ahead of the others
+        if self._sfprogress:
+            with self._sflock:
+                # if the worker is reading it already, wait for that instead of loading it twice
+                while self._sfloading == sfont:
+                    self._sfloaded.wait()
+                self._sfload(sfont, self._sfont_ramsize(sfont))
+        else:
+            self._reload_bankfonts()
+
+    def _unload_soundfont(self, sfont):
+        self._fluid.unload_soundfont(joinpath(self.sfdir, sfont))
+        del self._soundfonts[sfont]
+        for channel, preset in self._programs.items():
+            if preset and preset[1] == sfont:
+                self._programs[channel] = None
+
+    def _sfont_ramsize(self, sfont):
+    # estimate the memory a soundfont will use once loaded, mostly its sample data
+        try:
+            return self._sfindex_cache().read_index(sfont).samplebytes
+        except (OSError, sf2index.SF2Error):
+            pass
+        try:
+            return os.path.getsize(joinpath(self.sfdir, sfont))
+        except OSError:
+            return 0
+
+    def _sfindex_cache(self):
+        cachefile = joinpath(self.sfdir, SFINDEX_CACHE)
+        if not self._sfindex or self._sfindex.cachefile != cachefile:
+            self._sfindex = sf2index.IndexCache(cachefile)
+        return self._sfindex
+
+    def _resolve_patch(self, patch, edit=False):
+    # if :edit, make sure changes to the patch stay in the bank
         if isinstance(patch, int):
-            if patch < 0 or patch >= len(self._bank['patches']):
+            if patch < 0 or patch >= len(self._patch_names):
                 raise PatcherError("Patch index out of range")
-            name = list(self._bank['patches'])[patch]
-            patch = self._bank['patches'][name]
+            name = self._patch_names[patch]
         elif isinstance(patch, str):
             name = patch
-            if name not in self._bank['patches']:
+            if name not in self._patch_indexes:
                 raise PatcherError("Patch not found: %s" % name)
-            patch = self._bank['patches'][name]
-        return patch
+        else:
+            return patch
+        if edit and isinstance(self._bank['patches'], yamlext.LazyPatches):
+            self._bank['patches'].pin(name)
+        return self._bank['patches'][name]
         
     def _parse_sysex(self, messages):
         ports = {}
@@ -398,10 +759,7 @@ class Patcher:
         elif audioports == 'stereo':
             audioports = ('Input L', 'Input R', 'Output L', 'Output R')
 
-        if len(audioports) == 4:
-            names = (name, )
-        elif len(audioports) == 2:
-            names = (name + 'L', name + 'R')
+        names = self._fx_labels(name, audioports)
         for x in names:
             if not self._fluid.fxchain_add(x, libpath, plugin):
                 return "Could not connect plugin %s" % lib
@@ -422,24 +780,99 @@ class Patcher:
             self._fluid.fxchain_link(names[1], audioports[0], 'Main:R')
             self._fluid.fxchain_link(names[1], audioports[1], 'Main:R')
 
+    def _fx_labels(self, name, audioports):
+    # stereo plugins get one instance, mono plugins one per channel
+        if audioports == 'mono' or len(audioports) == 2:
+            return (name + 'L', name + 'R')
+        return (name, )
+
+    def _fx_fingerprint(self, lib, plugin=None, audioports='stereo', controls=[]):
+    # effects with the same fingerprint can be reused by changing their control values
+        if not isinstance(audioports, str):
+            audioports = tuple(audioports)
+        ports = tuple(sorted(ctrl.port for ctrl in controls if hasattr(ctrl, 'val')))
+        return lib, plugin, audioports, ports
+
+    def _fx_controls(self, effects):
+    # the control values :effects set, by (label, port)
+        vals = {}
+        for n, effect in enumerate(effects, 1):
+            for x in self._fx_labels('e%s' % n, effect.get('audioports', 'stereo')):
+                for ctrl in effect.get('controls', []):
+                    if hasattr(ctrl, 'val'):
+                        vals[x, ctrl.port] = ctrl.val
+        return vals
+
     def _midi_route(self, type, chan=None, par1=None, par2=None, **kwargs):
     # send midi message routing rules to fluidsynth
+        for rule in self._merge_rules(self._route_rules(type, chan, par1, par2)):
+            self._fluid.router_addrule(*rule)
+
+    def _compile_router(self, rules):
+    # reduce a list of router rules and 'clear'/'default' to a canonical table that sets up
+    # the same routing starting from the default rules - 'default' first if the default rules
+    # are kept, then the rules with duplicates removed and runs of channels merged
+    # setting the default rules in fluidsynth removes any others, so 'default' acts like 'clear' too
+        default = True
+        table = {}
+        for rule in rules:
+            if rule in ('clear', 'default'):
+                default = rule == 'default'
+                table = {}
+            else:
+                table[rule] = None
+        return ('default', ) * default + self._merge_rules(table)
+
+    def _merge_rules(self, rules):
+    # replace rules that only differ in their single source channel, whose destination
+    # channels are all the same or step along with the source, by one rule for the whole range
+        merged = set()
+        singles = {}
+        for rule in rules:
+            type, chan, par1, par2 = rule
+            if chan and chan[0] == chan[1] and chan[2] == 0 and isinstance(chan[3], int):
+                singles.setdefault((type, par1, par2), set()).add((chan[0], chan[3]))
+            else:
+                merged.add(rule)
+        for (type, par1, par2), pairs in singles.items():
+            for mul in (0, 1):
+                offsets = {}
+                for chfrom, chto in pairs:
+                    offsets.setdefault(chto - chfrom * mul, []).append(chfrom)
+                for add, chans in offsets.items():
+                    chans.sort()
+                    start = 0
+                    for i in range(1, len(chans) + 1):
+                        if i == len(chans) or chans[i] != chans[i - 1] + 1:
+                            if i - start > 1:
+                                merged.add((type, (chans[start], chans[i - 1], mul, add), par1, par2))
+                                pairs -= {(ch, ch * mul + add) for ch in chans[start:i]}
+                            start = i
+            for chfrom, chto in pairs:
+                merged.add((type, (chfrom, chfrom, 0, chto), par1, par2))
+        return tuple(sorted(merged, key=repr))
+
+    def _route_rules(self, type, chan=None, par1=None, par2=None, **kwargs):
+    # expand channel/parameter ranges into a list of fluidsynth router rules
         if isinstance(chan, yamlext.FromToSpec):
+            rules = []
             for chto in range(chan.to1, chan.to2 + 1):
                 ch = yamlext.RouterSpec(chan.from1, chan.from2, 0, chto)
-                self._midi_route(type, ch, par1, par2, **kwargs)
-            return
+                rules += self._route_rules(type, ch, par1, par2, **kwargs)
+            return rules
         if isinstance(chan, yamlext.RouterSpec):
+            rules = []
             for chfrom in range(chan.min, chan.max + 1):
-                ch = [chfrom - 1, chfrom - 1, 0, chfrom * chan.mul + chan.add - 1]
-                self._midi_route(type, ch, par1, par2)
-            return
+                ch = (chfrom - 1, chfrom - 1, 0, chfrom * chan.mul + chan.add - 1)
+                rules += self._route_rules(type, ch, par1, par2)
+            return rules
         if isinstance(par1, yamlext.FromToSpec):
             if type == 'cc':
+                rules = []
                 for ccto in range(par1.to1, par1.to2 + 1):
                     p = yamlext.RouterSpec(par1.from1, par1.from2, 0, ccto)
-                    self._midi_route(type, chan, p, par2, **kwargs)
-                return
+                    rules += self._route_rules(type, chan, p, par2, **kwargs)
+                return rules
             else:
                 par1 = yamlext.RouterSpec.fromtospec(par1)
         if isinstance(par1, yamlext.RouterSpec):
@@ -448,13 +881,36 @@ class Patcher:
             par2 = yamlext.RouterSpec.fromtospec(par2)
         if isinstance(par2, yamlext.RouterSpec):
             par2 = par2.vals
-        self._fluid.router_addrule(type, chan, par1, par2)
-
-    def _send_cc_defaults(self, channels=[]):
-        for channel in channels or range(1, self._max_channels + 1):
-            for first, last, default in CC_DEFAULTS:
-                for cc in range(first, last + 1):
-                    self._fluid.send_cc(channel - 1, cc, default)
+        return [(type, chan and tuple(chan), par1, par2)]
+
+    def _render_frames(self, audio, frame, end, block, blockfunc):
+    # add the audio up to frame :end, returns the new frame count
+        while frame < end:
+            n = min(end - frame, block)
+            t = time.perf_counter()
+            audio.extend(self._fluid.write_float(n))
+            if blockfunc:
+                blockfunc(n, time.perf_counter() - t)
+            frame += n
+        return frame
+
+    def _send_cc_defaults(self):
+    # read the controllers in one pass and only send the defaults that differ
+    # fluidsynth has no call that resets just these, and reads are much cheaper
+    # than sending, which updates every voice on the channel
+    # every channel is reset, since bank init messages and MIDI devices can change any of them
+        ccs = [(chan, cc, default) for chan in range(self._max_channels)
+               for first, last, default in CC_DEFAULTS for cc in range(first, last + 1)]
+        for (chan, cc, default), val in zip(ccs, self._fluid.get_ccs([x[:2] for x in ccs])):
+            if val != default:
+                self._fluid.send_cc(chan, cc, default)
+
+    def _unset_untracked(self):
+    # select_patch only visits channels the patcher has selected presets on, so clear
+    # presets that MIDI program changes may have put on any others
+        for channel in range(1, self._max_channels + 1):
+            if channel not in self._programs:
+                self._fluid.program_unset(channel - 1)
         
     def _reset_synth_defaults(self):
         cfg_fset = self.cfg.get('fluidsettings', {})
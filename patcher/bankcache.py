@@ -0,0 +1,71 @@
+"""
+Description: keeps parsed banks in a binary cache so they can be loaded
+    without parsing the YAML again, as long as the text is unchanged
+"""
+import os, hashlib, pickle
+from . import yamlext
+
+# change this whenever the classes in yamlext change in a way that breaks old pickles
+CACHE_FORMAT = 2
+CACHE_MAX = 32
+
+SAFE_CLASSES = {
+    ('builtins', 'dict'), ('builtins', 'list'), ('builtins', 'set'),
+    ('collections', 'OrderedDict'), ('copyreg', '_reconstructor'),
+    ('builtins', 'object'), ('builtins', 'tuple')
+}
+SAFE_YAMLEXT = {'SFPreset', 'PresetRecord', 'CCMsg', 'RouterSpec', 'FromToSpec', 'FlowSeq', 'FlowMap'}
+
+
+class BankCache:
+# one pickle file per bank, named by a hash of the bank text
+# only the most recently used CACHE_MAX files are kept
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def read_bank(self, text, parse):
+    # return the parsed bank for :text from the cache, or :parse(text) and cache it
+        cachefile = os.path.join(self.cachedir, _textkey(text) + '.pickle')
+        try:
+            with open(cachefile, 'rb') as f:
+                bank = _Unpickler(f).load()
+            os.utime(cachefile)
+            return bank
+        except Exception:
+            pass # missing or unreadable - parse it
+        bank = parse(text)
+        if isinstance(bank, dict):
+            self._save(cachefile, bank)
+        return bank
+
+    def _save(self, cachefile, bank):
+        tmpfile = cachefile + '.tmp'
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            with open(tmpfile, 'wb') as f:
+                pickle.dump(bank, f, protocol=4)
+            os.replace(tmpfile, cachefile)
+            self._prune()
+        except (OSError, pickle.PicklingError):
+            pass # read-only bank directory - just parse every time
+
+    def _prune(self):
+        files = [os.path.join(self.cachedir, f) for f in os.listdir(self.cachedir) if f.endswith('.pickle')]
+        if len(files) > CACHE_MAX:
+            files.sort(key=os.path.getmtime)
+            for f in files[:-CACHE_MAX]:
+                os.remove(f)
+
+
+class _Unpickler(pickle.Unpickler):
+# only rebuild the kinds of objects a parsed bank can contain
+
+    def find_class(self, module, name):
+        if (module, name) in SAFE_CLASSES or (module == yamlext.__name__ and name in SAFE_YAMLEXT):
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError("%s.%s not allowed in bank cache" % (module, name))
+
+
+def _textkey(text):
+    return hashlib.sha1(('%d:%s' % (CACHE_FORMAT, text)).encode()).hexdigest()
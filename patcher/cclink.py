@@ -1,24 +1,69 @@
 """
 Description: monitors a CC message for change and links it to a fluid setting or effects control
 """
+from array import array
+from .yamlext import scinote_to_val
 
-class CCLink:
+class CCTable:
+# shadow copy of the CC values of every channel, refreshed in one pass
+# so each link can check for changes without a call into fluidsynth
 
-    def __init__(self, fluid, target, link, type, xfrm, **kwargs):
+    def __init__(self, fluid, channels):
         self.fluid = fluid
+        self.channels = channels
+        # the extra last slot stands in for links to channels the synth doesn't have
+        self.vals = array('h', [0] * (channels * 128 + 1))
+        self.watched = []
+        self.ccs = []
+
+    def index(self, chan, cc):
+        if 1 <= chan <= self.channels and 0 <= cc < 128:
+            return (chan - 1) * 128 + cc
+        return len(self.vals) - 1
+
+    def read(self, index):
+        if index < len(self.vals) - 1:
+            self.vals[index] = self.fluid.get_cc(*divmod(index, 128))
+        return self.vals[index]
+
+    def update(self, chan, cc, val):
+    # store a value received as an event, returns its index or None if not tracked
+        if 0 <= chan < self.channels and 0 <= cc < 128:
+            index = chan * 128 + cc
+            self.vals[index] = val
+            return index
+        return None
+
+    def watch(self, links):
+        self.watched = sorted({link.index for link in links} - {len(self.vals) - 1})
+        self.ccs = [divmod(i, 128) for i in self.watched]
+
+    def refresh(self):
+        for i, val in zip(self.watched, self.fluid.get_ccs(self.ccs)):
+            self.vals[i] = val
+
+
+class CCLink:
+# lut maps each CC value to the transformed target value, or None if xfrm ignores it
+# action is set by the owner to a function that applies a value to the target
+
+    def __init__(self, cctable, target, link, type, xfrm, **kwargs):
         self.target = target
         self.channel, self.cc = map(int, link.split('/'))
         self.type = type
         self.xfrm = xfrm
+        self.action = None
         for a in kwargs:
             setattr(self, a, kwargs[a])
-        self.val = self.fluid.get_cc(self.channel - 1, self.cc)
+        self.index = cctable.index(self.channel, self.cc)
+        self.val = cctable.read(self.index)
+        lo, hi = scinote_to_val(xfrm.min), scinote_to_val(xfrm.max)
+        self.lut = [v * xfrm.mul + xfrm.add if lo <= v <= hi else None for v in range(128)]
 
-    def haschanged(self):
-        val = self.fluid.get_cc(self.channel - 1, self.cc)
+    def haschanged(self, cctable):
+        val = cctable.vals[self.index]
         if val != self.val:
             self.val = val
             return True
         else:
             return False
-            
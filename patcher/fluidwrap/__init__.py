@@ -1,8 +1,12 @@
 """
 Description: ctypes wrapper for fluidsynth library
 """
+import os
 
-try:
-    from .fluid2x import *
-except:
-    from .fluid1x import *
+if os.environ.get('FLUIDWRAP_SYNTH') == 'recorder':
+    from .recorder import *
+else:
+    try:
+        from .fluid2x import *
+    except:
+        from .fluid1x import *
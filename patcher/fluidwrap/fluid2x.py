@@ -3,6 +3,8 @@ Description: ctypes bindings for fluidsynth 2.x
 """
 from ctypes import *
 from ctypes.util import find_library
+from collections import deque, namedtuple
+from array import array
 import os
 
 if hasattr(os, 'add_dll_directory'):
@@ -48,6 +50,8 @@ FL.fluid_settings_getnum.argtypes = [c_void_p, c_char_p, POINTER(c_double)]
 FL.fluid_settings_getnum.restype = c_int
 FL.fluid_settings_copystr.argtypes = [c_void_p, c_char_p, c_char_p, c_int]
 FL.fluid_settings_copystr.restype = c_int
+FL.fluid_settings_get_type.argtypes = [c_void_p, c_char_p]
+FL.fluid_settings_get_type.restype = c_int
 
 FL.fluid_synth_handle_midi_event.argtypes = [c_void_p, c_void_p]
 FL.fluid_synth_handle_midi_event.restype = c_int
@@ -72,6 +76,28 @@ FL.fluid_synth_noteoff.restype = c_int
 
 FL.fluid_midi_router_handle_midi_event.argtypes = [c_void_p, c_void_p]
 FL.fluid_midi_router_handle_midi_event.restype = c_int
+FL.fluid_midi_event_get_type.argtypes = [c_void_p]
+FL.fluid_midi_event_get_type.restype = c_int
+FL.fluid_midi_event_get_channel.argtypes = [c_void_p]
+FL.fluid_midi_event_get_channel.restype = c_int
+FL.fluid_midi_event_get_control.argtypes = [c_void_p]
+FL.fluid_midi_event_get_control.restype = c_int
+FL.fluid_midi_event_get_value.argtypes = [c_void_p]
+FL.fluid_midi_event_get_value.restype = c_int
+FL.new_fluid_midi_event.argtypes = []
+FL.new_fluid_midi_event.restype = c_void_p
+FL.fluid_midi_event_set_type.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_type.restype = c_int
+FL.fluid_midi_event_set_channel.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_channel.restype = c_int
+FL.fluid_midi_event_set_key.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_key.restype = c_int
+FL.fluid_midi_event_set_value.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_value.restype = c_int
+FL.fluid_synth_write_float.argtypes = [c_void_p, c_int, c_void_p, c_int, c_int, c_void_p, c_int, c_int]
+FL.fluid_synth_write_float.restype = c_int
+FL.fluid_synth_get_active_voice_count.argtypes = [c_void_p]
+FL.fluid_synth_get_active_voice_count.restype = c_int
 FL.fluid_midi_router_clear_rules.argtypes = [c_void_p]
 FL.fluid_midi_router_clear_rules.restype = c_int
 FL.fluid_midi_router_set_default_rules.argtypes = [c_void_p]
@@ -92,6 +118,14 @@ FL.fluid_sfont_get_preset.argtypes = [c_void_p, c_int, c_int]
 FL.fluid_sfont_get_preset.restype = c_void_p
 FL.fluid_preset_get_name.argtypes = [c_void_p]
 FL.fluid_preset_get_name.restype = c_char_p
+FL.fluid_preset_get_banknum.argtypes = [c_void_p]
+FL.fluid_preset_get_banknum.restype = c_int
+FL.fluid_preset_get_num.argtypes = [c_void_p]
+FL.fluid_preset_get_num.restype = c_int
+FL.fluid_sfont_iteration_start.argtypes = [c_void_p]
+FL.fluid_sfont_iteration_start.restype = None
+FL.fluid_sfont_iteration_next.argtypes = [c_void_p]
+FL.fluid_sfont_iteration_next.restype = c_void_p
 
 FL.fluid_synth_get_ladspa_fx.argtypes = [c_void_p]
 FL.fluid_synth_get_ladspa_fx.restype = c_void_p
@@ -106,58 +140,161 @@ FL.fluid_ladspa_add_effect.restype = c_int
 FL.fluid_ladspa_effect_link.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
 FL.fluid_ladspa_effect_link.restype = c_int
 
+# settings that can be changed directly on a running synth instead of through the settings table
+# (function, function for all fx groups in newer versions, value type)
+REALTIME_FUNCTIONS = {
+    'synth.gain': ('fluid_synth_set_gain', None, c_float),
+    'synth.reverb.room-size': ('fluid_synth_set_reverb_roomsize', 'fluid_synth_set_reverb_group_roomsize', c_double),
+    'synth.reverb.damp': ('fluid_synth_set_reverb_damp', 'fluid_synth_set_reverb_group_damp', c_double),
+    'synth.reverb.width': ('fluid_synth_set_reverb_width', 'fluid_synth_set_reverb_group_width', c_double),
+    'synth.reverb.level': ('fluid_synth_set_reverb_level', 'fluid_synth_set_reverb_group_level', c_double),
+    'synth.chorus.nr': ('fluid_synth_set_chorus_nr', 'fluid_synth_set_chorus_group_nr', c_int),
+    'synth.chorus.level': ('fluid_synth_set_chorus_level', 'fluid_synth_set_chorus_group_level', c_double),
+    'synth.chorus.speed': ('fluid_synth_set_chorus_speed', 'fluid_synth_set_chorus_group_speed', c_double),
+    'synth.chorus.depth': ('fluid_synth_set_chorus_depth', 'fluid_synth_set_chorus_group_depth', c_double)
+}
+REALTIME_SETTINGS = {}
+for opt, (name, groupname, ctype) in REALTIME_FUNCTIONS.items():
+    if groupname and hasattr(FL, groupname):
+        func = getattr(FL, groupname)
+        func.argtypes = [c_void_p, c_int, ctype]
+        func.restype = c_int
+        REALTIME_SETTINGS[opt] = (lambda synth, val, func=func: func(synth, -1, val)), ctype
+    elif hasattr(FL, name):
+        func = getattr(FL, name)
+        func.argtypes = [c_void_p, ctype]
+        func.restype = None if name == 'fluid_synth_set_gain' else c_int
+        REALTIME_SETTINGS[opt] = func, ctype
+
+# a snapshot of the synth - programs holds (sfont, bank, prog) or None for each of
+# the channels, and ccs the values of the controllers in ccnums, channel by channel
+SynthState = namedtuple('SynthState', 'channels programs ccnums ccs settings router')
+
 FLUID_OK = 0
 FLUID_FAILED = -1
+CONTROL_CHANGE = 0xb0
 FLUIDSETTING_EXISTS = FLUID_OK
+FLUID_NUM_TYPE = 0
+FLUID_INT_TYPE = 1
+FLUID_STR_TYPE = 2
 
 class Synth:
 
-    def __init__(self, **settings):
+    def __init__(self, ccqueue=False, offline=False, **settings):
+    # an :offline synth has no audio or MIDI drivers - audio is pulled with write_float
+    # and MIDI messages are passed in with send_event
         self.st = FL.new_fluid_settings()
+        # native type, last known value, and bound setter of each setting used
+        self._settypes = {}
+        self._setvals = {}
+        self._setters = {}
+        self.synth = None
         for opt, val in settings.items():
             self.setting(opt, val)
 
         self.synth = FL.new_fluid_synth(self.st)
-        FL.new_fluid_audio_driver(self.st, self.synth)
+        self._setters = {}
+        if not offline:
+            FL.new_fluid_audio_driver(self.st, self.synth)
         self.fx = FL.fluid_synth_get_ladspa_fx(self.synth)
-        self.synth_eventhandle = fl_callback(FL.fluid_synth_handle_midi_event)
+        if ccqueue:
+            # CC messages the router passes on to the synth are also pushed into ccqueue as (chan, cc, val)
+            self.ccqueue = deque()
+            self.synth_eventhandle = fl_callback(self._synth_event)
+        else:
+            self.ccqueue = None
+            self.synth_eventhandle = fl_callback(FL.fluid_synth_handle_midi_event)
         self.router = FL.new_fluid_midi_router(self.st, self.synth_eventhandle, self.synth)
         self.driver_eventhandle = fl_callback(FL.fluid_midi_router_handle_midi_event)
-        FL.new_fluid_midi_driver(self.st, self.driver_eventhandle, self.router)
+        if not offline:
+            FL.new_fluid_midi_driver(self.st, self.driver_eventhandle, self.router)
+        self.event = FL.new_fluid_midi_event()
+        self.audiobuf = (c_float * 0)()
 
         self.sfid = {}
+        self.sfpath = {}
+        self.ccval = c_int()
+        self.router_rules = ['default']
+
+    def _synth_event(self, synth, event):
+        if FL.fluid_midi_event_get_type(event) == CONTROL_CHANGE:
+            self.ccqueue.append((FL.fluid_midi_event_get_channel(event),
+                                 FL.fluid_midi_event_get_control(event),
+                                 FL.fluid_midi_event_get_value(event)))
+        return FL.fluid_synth_handle_midi_event(synth, event)
 
     def setting(self, opt, val):
-        if isinstance(val, str):
-            FL.fluid_settings_setstr(self.st, opt.encode(), val.encode())
-        elif isinstance(val, int):
-            FL.fluid_settings_setint(self.st, opt.encode(), val)
-        elif isinstance(val, float):
-            FL.fluid_settings_setnum(self.st, opt.encode(), c_double(val))
+        self.setting_setter(opt)(val)
 
     def get_setting(self, opt):
-        val = c_int()
-        if FL.fluid_settings_getint(self.st, opt.encode(), byref(val)) == FLUIDSETTING_EXISTS:
-            return val.value
-        strval = create_string_buffer(32)
-        if FL.fluid_settings_copystr(self.st, opt.encode(), strval, 32) == FLUIDSETTING_EXISTS:
-            return strval.value.decode()
-        num = c_double()
-        if FL.fluid_settings_getnum(self.st, opt.encode(), byref(num)) == FLUIDSETTING_EXISTS:
-            return round(num.value, 6)
-        return None
+        if opt not in self._setvals:
+            name = opt.encode()
+            stype = self._setting_type(opt)
+            if stype == FLUID_INT_TYPE:
+                val = c_int()
+                if FL.fluid_settings_getint(self.st, name, byref(val)) == FLUIDSETTING_EXISTS:
+                    self._setvals[opt] = val.value
+            elif stype == FLUID_NUM_TYPE:
+                num = c_double()
+                if FL.fluid_settings_getnum(self.st, name, byref(num)) == FLUIDSETTING_EXISTS:
+                    self._setvals[opt] = num.value
+            elif stype == FLUID_STR_TYPE:
+                strval = create_string_buffer(32)
+                if FL.fluid_settings_copystr(self.st, name, strval, 32) == FLUIDSETTING_EXISTS:
+                    self._setvals[opt] = strval.value.decode()
+        val = self._setvals.get(opt)
+        return round(val, 6) if isinstance(val, float) else val
+
+    def setting_setter(self, opt):
+    # a function that sets :opt, with the name encoded and the setter for the
+    # setting's type chosen once; values are converted to that type, and
+    # writes that wouldn't change the last value set or read are dropped
+    # once the synth is running, settings in REALTIME_SETTINGS are set on it directly
+        if opt in self._setters:
+            return self._setters[opt]
+        name = opt.encode()
+        stype = self._setting_type(opt)
+        if opt in REALTIME_SETTINGS and self.synth:
+            conv = round if REALTIME_SETTINGS[opt][1] == c_int else float
+            func = lambda st, name, val: REALTIME_SETTINGS[opt][0](self.synth, val)
+        elif stype == FLUID_INT_TYPE:
+            conv, func = round, FL.fluid_settings_setint
+        elif stype == FLUID_NUM_TYPE:
+            conv, func = float, FL.fluid_settings_setnum
+        elif stype == FLUID_STR_TYPE:
+            conv, func = str, lambda st, name, val: FL.fluid_settings_setstr(st, name, val.encode())
+        else:
+            return lambda val: None
+        def setter(val):
+            try:
+                val = conv(val)
+            except (TypeError, ValueError):
+                return
+            if self._setvals.get(opt) != val:
+                if func(self.st, name, val) in (FLUIDSETTING_EXISTS, None):
+                    self._setvals[opt] = val
+                else:
+                    self._setvals.pop(opt, None)
+        self._setters[opt] = setter
+        return setter
+
+    def _setting_type(self, opt):
+        if opt not in self._settypes:
+            self._settypes[opt] = FL.fluid_settings_get_type(self.st, opt.encode())
+        return self._settypes[opt]
 
     def load_soundfont(self, sfont):
         id = FL.fluid_synth_sfload(self.synth, sfont.encode(), False)
         if id == FLUID_FAILED:
             return False
         self.sfid[sfont] = id
+        self.sfpath[id] = sfont
         return True
 
     def unload_soundfont(self, sfont):
         if FL.fluid_synth_sfunload(self.synth, self.sfid[sfont], False) == FLUID_FAILED:
             return False
-        del self.sfid[sfont]
+        del self.sfpath[self.sfid.pop(sfont)]
         return True
 
     def get_preset_name(self, sfont, bank, prog):
@@ -167,6 +304,20 @@ class Synth:
             return None
         return FL.fluid_preset_get_name(preset_obj).decode('ascii')
 
+    def get_presets(self, sfont):
+    # list the (name, bank, prog) of all presets in :sfont
+        sfont_obj = FL.fluid_synth_get_sfont_by_id(self.synth, self.sfid[sfont])
+        presets = []
+        FL.fluid_sfont_iteration_start(sfont_obj)
+        while True:
+            preset_obj = FL.fluid_sfont_iteration_next(sfont_obj)
+            if not preset_obj:
+                break
+            presets.append((FL.fluid_preset_get_name(preset_obj).decode('ascii'),
+                            FL.fluid_preset_get_banknum(preset_obj),
+                            FL.fluid_preset_get_num(preset_obj)))
+        return sorted(presets, key=lambda p: p[1:])
+
     def program_select(self, chan, sfont, bank, prog):
         if sfont not in self.sfid:
             return False
@@ -183,10 +334,30 @@ class Synth:
         bank = c_int()
         prog = c_int()
         FL.fluid_synth_get_program(self.synth, chan, byref(id), byref(bank), byref(prog))
-        if id.value not in self.sfid.values():
+        if id.value not in self.sfpath:
             return None
-        sfont = {v: k for k, v in self.sfid.items()}[id.value]
-        return sfont, bank.value, prog.value
+        return self.sfpath[id.value], bank.value, prog.value
+
+    def send_event(self, type, chan, par1, par2=0):
+    # pass a MIDI message to the router as if it came from the MIDI driver
+    # :type is the status byte without the channel, pitch bends have the full value in :par1
+        FL.fluid_midi_event_set_type(self.event, type)
+        FL.fluid_midi_event_set_channel(self.event, chan)
+        FL.fluid_midi_event_set_key(self.event, par1)
+        FL.fluid_midi_event_set_value(self.event, par2)
+        FL.fluid_midi_router_handle_midi_event(self.router, self.event)
+
+    def write_float(self, nframes):
+    # synthesize :nframes of audio, returned as an array of interleaved stereo floats
+        if len(self.audiobuf) < nframes * 2:
+            self.audiobuf = (c_float * (nframes * 2))()
+        FL.fluid_synth_write_float(self.synth, nframes, self.audiobuf, 0, 2, self.audiobuf, 1, 2)
+        audio = array('f')
+        audio.frombytes(memoryview(self.audiobuf).cast('B')[:nframes * 8])
+        return audio
+
+    def active_voices(self):
+        return FL.fluid_synth_get_active_voice_count(self.synth)
 
     def noteon(self, chan, key, vel):
         FL.fluid_synth_noteon(self.synth, chan, key, vel)
@@ -196,17 +367,32 @@ class Synth:
 
     def send_cc(self, chan, ctrl, val):
         FL.fluid_synth_cc(self.synth, chan, ctrl, val)
+        if self.ccqueue != None:
+            self.ccqueue.append((chan, ctrl, val))
 
     def get_cc(self, chan, num):
-        i=c_int()
-        FL.fluid_synth_get_cc(self.synth, chan, num, byref(i))
-        return i.value
+        FL.fluid_synth_get_cc(self.synth, chan, num, byref(self.ccval))
+        return self.ccval.value
+
+    def get_ccs(self, ccs):
+    # read a list of (chan, num) CC values in one pass
+        vals = []
+        get_cc = FL.fluid_synth_get_cc
+        synth = self.synth
+        ccval = self.ccval
+        ref = byref(ccval)
+        for chan, num in ccs:
+            get_cc(synth, chan, num, ref)
+            vals.append(ccval.value)
+        return vals
 
     def router_clear(self):
         FL.fluid_midi_router_clear_rules(self.router)
+        self.router_rules = []
 
     def router_default(self):
         FL.fluid_midi_router_set_default_rules(self.router)
+        self.router_rules = ['default']
 
     def router_addrule(self, type, chan, par1, par2):
         rule = FL.new_fluid_midi_router_rule()
@@ -218,6 +404,40 @@ class Synth:
         if par2:
             FL.fluid_midi_router_rule_set_param2(rule, *par2)
         FL.fluid_midi_router_add_rule(self.router, rule, ntype)
+        self.router_rules.append((type, chan, par1, par2))
+
+    def snapshot(self, channels=None, ccnums=range(128)):
+    # capture the programs and CC values of :channels (all by default), the
+    # settings that have been set or read, and the router rules
+        if channels == None:
+            channels = range(self.get_setting('synth.midi-channels'))
+        channels, ccnums = tuple(channels), tuple(ccnums)
+        programs = tuple(self.program_info(chan) for chan in channels)
+        ccs = array('h', self.get_ccs([(chan, num) for chan in channels for num in ccnums]))
+        return SynthState(channels, programs, ccnums, ccs, tuple(self._setvals.items()), tuple(self.router_rules))
+
+    def restore(self, state):
+    # return the synth to a SynthState, only changing what differs from the present state
+    # returns False if any of the programs couldn't be selected
+        ok = True
+        for chan, info in zip(state.channels, state.programs):
+            if self.program_info(chan) != info:
+                if info == None:
+                    self.program_unset(chan)
+                elif not self.program_select(chan, *info):
+                    ok = False
+        ccs = [(chan, num) for chan in state.channels for num in state.ccnums]
+        for (chan, num), val, saved in zip(ccs, self.get_ccs(ccs), state.ccs):
+            if val != saved:
+                self.send_cc(chan, num, saved)
+        for opt, val in state.settings:
+            self.setting(opt, val)
+        if tuple(self.router_rules) != state.router:
+            self.router_clear()
+            for rule in state.router:
+                if rule == 'default': self.router_default()
+                else: self.router_addrule(*rule)
+        return ok
 
     def fxchain_clear(self):
         FL.fluid_ladspa_reset(self.fx)
@@ -239,4 +459,9 @@ class Synth:
         
     def fx_setcontrol(self, label, port, val):
         FL.fluid_ladspa_effect_set_control(self.fx, label.encode(), port.encode(), c_float(val))
+
+    def fx_setter(self, label, port):
+    # a function that sets the control :port of effect :label, with the names encoded once
+        label, port = label.encode(), port.encode()
+        return lambda val: FL.fluid_ladspa_effect_set_control(self.fx, label, port, val)
         
\ No newline at end of file
@@ -0,0 +1,314 @@
+"""
+Description: an in-process stand-in for the fluidsynth bindings
+    keeps enough state to behave like a synth, and records/counts
+    the library calls the real bindings would have made
+    select it by setting the environment variable FLUIDWRAP_SYNTH=recorder
+"""
+import time
+from collections import Counter, deque, namedtuple
+from array import array
+
+# values fluidsynth starts with for settings that are read without being set
+DEFAULT_SETTINGS = {
+    'synth.sample-rate': 44100.0, 'synth.midi-channels': 16, 'synth.polyphony': 256,
+    'synth.gain': 0.2, 'synth.cpu-cores': 1, 'audio.period-size': 64, 'audio.periods': 16
+}
+
+SynthState = namedtuple('SynthState', 'channels programs ccnums ccs settings router')
+
+FLUID_OK = 0
+FLUID_FAILED = -1
+
+# settings set directly on the running synth, as by fluidsynth 2.2 and later
+REALTIME_SETTINGS = {
+    'synth.gain': 'fluid_synth_set_gain',
+    'synth.reverb.room-size': 'fluid_synth_set_reverb_group_roomsize',
+    'synth.reverb.damp': 'fluid_synth_set_reverb_group_damp',
+    'synth.reverb.width': 'fluid_synth_set_reverb_group_width',
+    'synth.reverb.level': 'fluid_synth_set_reverb_group_level',
+    'synth.chorus.nr': 'fluid_synth_set_chorus_group_nr',
+    'synth.chorus.level': 'fluid_synth_set_chorus_group_level',
+    'synth.chorus.speed': 'fluid_synth_set_chorus_group_speed',
+    'synth.chorus.depth': 'fluid_synth_set_chorus_group_depth'
+}
+
+class Synth:
+
+    def __init__(self, ccqueue=False, offline=False, **settings):
+        self.calls = Counter()
+        self.log = None
+        self.settings = {}
+        self._settypes = {}
+        self._typed = set()
+        self._setters = {}
+        self.synth = None
+        self._call('new_fluid_settings')
+        for opt, val in settings.items():
+            self.setting(opt, val)
+        self.channels = self.settings.get('synth.midi-channels', 16)
+
+        self._call('new_fluid_synth')
+        self.synth = True
+        self._setters = {}
+        if not offline:
+            self._call('new_fluid_audio_driver')
+        self._call('fluid_synth_get_ladspa_fx')
+        self._call('new_fluid_midi_router')
+        if not offline:
+            self._call('new_fluid_midi_driver')
+        self._call('new_fluid_midi_event')
+        self.notes = set()
+        # seconds each soundfont takes to load, to stand in for a slow disk
+        self.load_delay = 0
+        self.ccqueue = deque() if ccqueue else None
+
+        self.sfid = {}
+        self.sfpath = {}
+        self.programs = {}
+        self.ccs = [self._initial_ccs() for _ in range(self.channels)]
+        self.router_rules = ['default']
+        self.fxchain = []
+        self.fxcontrols = {}
+        self._nextid = 1
+        self.reset_counts()
+
+    @staticmethod
+    def _initial_ccs():
+    # the controller values fluidsynth gives a new channel
+        ccs = [0] * 128
+        for cc, val in ((7, 100), (8, 64), (10, 64), (11, 127), (43, 127), (84, 255),
+                        (98, 127), (99, 127), (100, 127), (101, 127)):
+            ccs[cc] = val
+        ccs[70:80] = [64] * 10
+        return ccs
+
+    def reset_counts(self):
+        self.calls = Counter()
+
+    def record(self, enable=True):
+    # keep an ordered log of (function, args) in addition to the counts
+        self.log = [] if enable else None
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def midi_cc(self, chan, ctrl, val):
+    # simulate a CC message reaching the synth from the MIDI router
+        self.ccs[chan][ctrl] = val
+        if self.ccqueue != None:
+            self.ccqueue.append((chan, ctrl, val))
+
+    def _call(self, func, *args):
+        self.calls[func] += 1
+        if self.log != None:
+            self.log.append((func, args))
+
+    def setting(self, opt, val):
+        if opt not in self._settypes and isinstance(val, (int, float, str)):
+            # the type the library would report, taken from the first value set
+            self._settypes[opt] = {int: 'int', float: 'num', str: 'str'}[type(val)]
+        self.setting_setter(opt)(val)
+
+    def get_setting(self, opt):
+        if opt not in self.settings:
+            if opt in DEFAULT_SETTINGS:
+                self._settypes.setdefault(opt, 'int' if isinstance(DEFAULT_SETTINGS[opt], int) else 'num')
+            stype = self._setting_type(opt)
+            self._call({'int': 'fluid_settings_getint', 'num': 'fluid_settings_getnum',
+                        'str': 'fluid_settings_copystr'}[stype], opt)
+            if opt in DEFAULT_SETTINGS:
+                self.settings[opt] = DEFAULT_SETTINGS[opt]
+        val = self.settings.get(opt)
+        return round(val, 6) if isinstance(val, float) else val
+
+    def setting_setter(self, opt):
+        if opt in self._setters:
+            return self._setters[opt]
+        stype = self._setting_type(opt)
+        conv, func = {'int': (round, 'fluid_settings_setint'), 'num': (float, 'fluid_settings_setnum'),
+                      'str': (str, 'fluid_settings_setstr')}[stype]
+        if opt in REALTIME_SETTINGS and self.synth:
+            func = REALTIME_SETTINGS[opt]
+        def setter(val):
+            try:
+                val = conv(val)
+            except (TypeError, ValueError):
+                return
+            if self.settings.get(opt) != val:
+                self._call(func, opt, val)
+                self.settings[opt] = val
+        self._setters[opt] = setter
+        return setter
+
+    def _setting_type(self, opt):
+    # settings that haven't been set are assumed to be numbers
+        if opt not in self._typed:
+            self._call('fluid_settings_get_type', opt)
+            self._typed.add(opt)
+        return self._settypes.setdefault(opt, 'num')
+
+    def load_soundfont(self, sfont):
+        self._call('fluid_synth_sfload', sfont)
+        time.sleep(self.load_delay)
+        self.sfid[sfont] = self._nextid
+        self.sfpath[self._nextid] = sfont
+        self._nextid += 1
+        return True
+
+    def unload_soundfont(self, sfont):
+        self._call('fluid_synth_sfunload', sfont)
+        id = self.sfid.pop(sfont)
+        del self.sfpath[id]
+        for chan, info in list(self.programs.items()):
+            if info[0] == id:
+                del self.programs[chan]
+        return True
+
+    def get_preset_name(self, sfont, bank, prog):
+        self._call('fluid_synth_get_sfont_by_id', sfont)
+        self._call('fluid_sfont_get_preset', bank, prog)
+        if bank == 0 or (bank == 128 and prog == 0):
+            self._call('fluid_preset_get_name')
+            return 'Preset %03d:%03d' % (bank, prog)
+        return None
+
+    def get_presets(self, sfont):
+        self._call('fluid_synth_get_sfont_by_id', sfont)
+        self._call('fluid_sfont_iteration_start')
+        presets = [('Preset %03d:%03d' % (0, prog), 0, prog) for prog in range(128)]
+        presets.append(('Preset %03d:%03d' % (128, 0), 128, 0))
+        for p in presets:
+            self._call('fluid_sfont_iteration_next')
+            self._call('fluid_preset_get_name')
+            self._call('fluid_preset_get_banknum')
+            self._call('fluid_preset_get_num')
+        self._call('fluid_sfont_iteration_next')
+        return presets
+
+    def program_select(self, chan, sfont, bank, prog):
+        if sfont not in self.sfid:
+            return False
+        self._call('fluid_synth_program_select', chan, sfont, bank, prog)
+        self.programs[chan] = (self.sfid[sfont], bank, prog)
+        return True
+
+    def program_unset(self, chan):
+        self._call('fluid_synth_unset_program', chan)
+        self.programs.pop(chan, None)
+
+    def program_info(self, chan):
+        self._call('fluid_synth_get_program', chan)
+        if chan not in self.programs:
+            return None
+        id, bank, prog = self.programs[chan]
+        return self.sfpath[id], bank, prog
+
+    def send_event(self, type, chan, par1, par2=0):
+        if type == 0xb0:
+            self.midi_cc(chan, par1, par2)
+        elif type == 0x90 and par2 > 0:
+            self.notes.add((chan, par1))
+        elif type in (0x80, 0x90):
+            self.notes.discard((chan, par1))
+        self._call('fluid_midi_router_handle_midi_event', type, chan, par1, par2)
+
+    def active_voices(self):
+    # one voice per held note
+        self._call('fluid_synth_get_active_voice_count')
+        return len(self.notes)
+
+    def write_float(self, nframes):
+    # silence, since nothing is synthesized
+        self._call('fluid_synth_write_float', nframes)
+        return array('f', bytes(nframes * 8))
+
+    def noteon(self, chan, key, vel):
+        self._call('fluid_synth_noteon', chan, key, vel)
+
+    def noteoff(self, chan, key):
+        self._call('fluid_synth_noteoff', chan, key)
+
+    def send_cc(self, chan, ctrl, val):
+        self._call('fluid_synth_cc', chan, ctrl, val)
+        self.ccs[chan][ctrl] = val
+        if self.ccqueue != None:
+            self.ccqueue.append((chan, ctrl, val))
+
+    def get_cc(self, chan, num):
+        self._call('fluid_synth_get_cc', chan, num)
+        return self.ccs[chan][num]
+
+    def get_ccs(self, ccs):
+        return [self.get_cc(chan, num) for chan, num in ccs]
+
+    def router_clear(self):
+        self._call('fluid_midi_router_clear_rules')
+        self.router_rules = []
+
+    def router_default(self):
+        self._call('fluid_midi_router_set_default_rules')
+        self.router_rules = ['default']
+
+    def router_addrule(self, type, chan, par1, par2):
+        self._call('new_fluid_midi_router_rule')
+        if chan:
+            self._call('fluid_midi_router_rule_set_chan', *chan)
+        if par1:
+            self._call('fluid_midi_router_rule_set_param1', *par1)
+        if par2:
+            self._call('fluid_midi_router_rule_set_param2', *par2)
+        self._call('fluid_midi_router_add_rule', type)
+        self.router_rules.append((type, chan, par1, par2))
+
+    def snapshot(self, channels=None, ccnums=range(128)):
+        if channels == None:
+            channels = range(self.channels)
+        channels, ccnums = tuple(channels), tuple(ccnums)
+        programs = tuple(self.program_info(chan) for chan in channels)
+        ccs = array('h', self.get_ccs([(chan, num) for chan in channels for num in ccnums]))
+        return SynthState(channels, programs, ccnums, ccs, tuple(self.settings.items()), tuple(self.router_rules))
+
+    def restore(self, state):
+        ok = True
+        for chan, info in zip(state.channels, state.programs):
+            if self.program_info(chan) != info:
+                if info == None:
+                    self.program_unset(chan)
+                elif not self.program_select(chan, *info):
+                    ok = False
+        ccs = [(chan, num) for chan in state.channels for num in state.ccnums]
+        for (chan, num), val, saved in zip(ccs, self.get_ccs(ccs), state.ccs):
+            if val != saved:
+                self.send_cc(chan, num, saved)
+        for opt, val in state.settings:
+            self.setting(opt, val)
+        if tuple(self.router_rules) != state.router:
+            self.router_clear()
+            for rule in state.router:
+                if rule == 'default': self.router_default()
+                else: self.router_addrule(*rule)
+        return ok
+
+    def fxchain_clear(self):
+        self._call('fluid_ladspa_reset')
+        self.fxchain = []
+        self.fxcontrols = {}
+
+    def fxchain_add(self, label, lib, plugin):
+        self._call('fluid_ladspa_add_effect', label, lib, plugin)
+        self.fxchain.append((label, lib, plugin))
+        return True
+
+    def fxchain_link(self, label, fromport, toport):
+        self._call('fluid_ladspa_effect_link', label, fromport, toport)
+        return True
+
+    def fxchain_activate(self):
+        self._call('fluid_ladspa_activate')
+
+    def fx_setcontrol(self, label, port, val):
+        self._call('fluid_ladspa_effect_set_control', label, port, val)
+        self.fxcontrols[label, port] = val
+
+    def fx_setter(self, label, port):
+        return lambda val: self.fx_setcontrol(label, port, val)
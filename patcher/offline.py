@@ -0,0 +1,41 @@
+"""
+Description: helpers for rendering audio offline - reads MIDI messages from
+    files or lists and writes the synthesized audio to WAV files
+"""
+import sys, struct, mido
+from array import array
+
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+def midi_events(source):
+# yield (time in seconds, status without channel, channel, par1, par2) for each
+# channel message in :source, a MIDI file name or a list of mido messages whose
+# time attributes are the seconds since the previous message, as mido plays files
+    if isinstance(source, str):
+        source = mido.MidiFile(source)
+    t = 0.0
+    for msg in source:
+        t += msg.time
+        if msg.is_meta or msg.type == 'sysex':
+            continue
+        data = msg.bytes()
+        if len(data) < 2:
+            continue
+        type, chan = data[0] & 0xf0, data[0] & 0x0f
+        if type == 0xe0:
+            yield t, type, chan, data[1] | data[2] << 7, 0
+        else:
+            yield t, type, chan, data[1], data[2] if len(data) > 2 else 0
+
+def write_wav(wavfile, audio, rate):
+# write interleaved stereo float :audio to :wavfile as 32-bit float samples
+    if sys.byteorder == 'big':
+        audio = array('f', audio)
+        audio.byteswap()
+    nframes = len(audio) // 2
+    with open(wavfile, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', 50 + nframes * 8) + b'WAVE')
+        f.write(b'fmt ' + struct.pack('<IHHIIHHH', 18, WAVE_FORMAT_IEEE_FLOAT, 2, int(rate), int(rate) * 8, 8, 32, 0))
+        f.write(b'fact' + struct.pack('<II', 4, nframes))
+        f.write(b'data' + struct.pack('<I', nframes * 8))
+        audio.tofile(f)
@@ -0,0 +1,156 @@
+"""
+Description: reads the preset, instrument, and sample headers of a .sf2 file
+    through mmap, without loading any sample data
+    indexes can be cached on disk so repeat visits don't need to read the file
+"""
+import os, mmap, struct, json
+from collections import namedtuple
+
+GEN_INSTRUMENT = 41
+GEN_SAMPLEID = 53
+
+SF2Preset = namedtuple('SF2Preset', 'name bank prog samplebytes')
+SF2Index = namedtuple('SF2Index', 'name presets samplebytes')
+
+class SF2Error(Exception):
+    pass
+
+def read_index(path):
+# get the name, presets, and total bytes of sample data in the soundfont at :path
+# each preset lists the bytes of sample data used by its instruments
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise SF2Error("Empty file: %s" % path)
+    try:
+        return _parse(buf)
+    except struct.error:
+        raise SF2Error("Truncated or corrupt soundfont: %s" % path)
+    finally:
+        buf.close()
+
+
+class IndexCache:
+# keeps soundfont indexes in a small JSON file in the soundfont directory
+# entries are keyed by path relative to that directory plus file size and mtime
+
+    def __init__(self, cachefile):
+        self.cachefile = cachefile
+        self.basedir = os.path.dirname(cachefile)
+        self.entries = None
+
+    def read_index(self, soundfont):
+        if self.entries == None:
+            self._load()
+        key = _filekey(os.path.join(self.basedir, soundfont))
+        entry = self.entries.get(soundfont)
+        if entry and entry['key'] == key:
+            presets = [SF2Preset(*p) for p in entry['presets']]
+            return SF2Index(entry['name'], presets, entry['samplebytes'])
+        index = read_index(os.path.join(self.basedir, soundfont))
+        self.entries[soundfont] = {'key': key, 'name': index.name, 'samplebytes': index.samplebytes,
+                                   'presets': [list(p) for p in index.presets]}
+        self._save()
+        return index
+
+    def _load(self):
+        self.entries = {}
+        try:
+            with open(self.cachefile) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(entries, dict):
+            return
+        for soundfont, entry in entries.items():
+            try:
+                if entry['key'] == _filekey(os.path.join(self.basedir, soundfont)):
+                    self.entries[soundfont] = entry
+            except (OSError, KeyError, TypeError):
+                pass
+        if len(self.entries) < len(entries):
+            self._save()
+
+    def _save(self):
+        tmpfile = self.cachefile + '.tmp'
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmpfile, self.cachefile)
+        except OSError:
+            pass # read-only soundfont directory - cache in memory only
+
+
+def _filekey(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def _chunks(buf, start, end):
+    while start + 8 <= end:
+        id, size = struct.unpack_from('<4sI', buf, start)
+        yield id, start + 8, min(size, end - start - 8)
+        start += 8 + size + (size & 1)
+
+def _name(raw):
+    return raw.split(b'\0', 1)[0].decode('ascii', 'replace')
+
+def _parse(buf):
+    riff, size, form = struct.unpack_from('<4sI4s', buf, 0)
+    if riff != b'RIFF' or form != b'sfbk':
+        raise SF2Error("Not a soundfont")
+    chunks = {}
+    for id, offset, size in _chunks(buf, 12, min(size + 8, len(buf))):
+        if id == b'LIST':
+            for subid, suboffset, subsize in _chunks(buf, offset + 4, offset + size):
+                chunks[subid] = suboffset, subsize
+
+    def records(id, fmt):
+        if id not in chunks:
+            raise SF2Error("Missing %s chunk" % id.decode())
+        offset, size = chunks[id]
+        n = size // struct.calcsize(fmt)
+        return list(struct.iter_unpack(fmt, buf[offset:offset + n * struct.calcsize(fmt)]))
+
+    name = ''
+    if b'INAM' in chunks:
+        offset, size = chunks[b'INAM']
+        name = _name(buf[offset:offset + size])
+    phdr = records(b'phdr', '<20sHHHIII')
+    pbag = records(b'pbag', '<HH')
+    pgen = records(b'pgen', '<HH')
+    inst = records(b'inst', '<20sH')
+    ibag = records(b'ibag', '<HH')
+    igen = records(b'igen', '<HH')
+    shdr = records(b'shdr', '<20sIIIIIBbHH')
+    samplesize = 3 if b'sm24' in chunks else 2
+
+    def zone_gens(bags, gens, first, last, oper):
+        # values of generator :oper in the zones first..last-1
+        vals = set()
+        for b in range(first, min(last, len(bags) - 1)):
+            for g in range(bags[b][0], min(bags[b + 1][0], len(gens))):
+                if gens[g][0] == oper:
+                    vals.add(gens[g][1])
+        return vals
+
+    inst_samples = {}
+    def samples(i):
+        if i not in inst_samples:
+            ids = zone_gens(ibag, igen, inst[i][1], inst[i + 1][1], GEN_SAMPLEID)
+            inst_samples[i] = {s for s in ids if s < len(shdr) - 1}
+        return inst_samples[i]
+
+    presets = []
+    for i in range(len(phdr) - 1):
+        pname, prog, bank, bagndx = phdr[i][:4]
+        used = set()
+        for n in zone_gens(pbag, pgen, bagndx, phdr[i + 1][3], GEN_INSTRUMENT):
+            if n < len(inst) - 1:
+                used |= samples(n)
+        nbytes = sum(max(shdr[s][2] - shdr[s][1], 0) * samplesize for s in used)
+        presets.append(SF2Preset(_name(pname), bank, prog, nbytes))
+    presets.sort(key=lambda p: (p.bank, p.prog))
+
+    samplebytes = sum(chunks[id][1] for id in (b'smpl', b'sm24') if id in chunks)
+    return SF2Index(name, presets, samplebytes)
@@ -1,8 +1,16 @@
 """
 Description: extensions to YAML classes for patcher
 """
-import re, oyaml
-from oyaml import safe_load, safe_load_all, safe_dump, safe_dump_all, YAMLError, YAMLObject
+import re, weakref, oyaml
+from collections import namedtuple, OrderedDict
+from collections.abc import MutableMapping
+from oyaml import YAMLError, YAMLObject
+
+# use libyaml's much faster parser/emitter when pyyaml was built with it
+if hasattr(oyaml, 'CSafeLoader'):
+    Loader, Dumper = oyaml.CSafeLoader, oyaml.CSafeDumper
+else:
+    Loader, Dumper = oyaml.SafeLoader, oyaml.SafeDumper
 
 
 sfpex = re.compile('^(.+):(\d+):(\d+)$')
@@ -31,68 +39,127 @@ def scinote_to_val(val):
     return sign * ((octave + 1) * 12 + note + acc)
 
 
-class SFPreset(YAMLObject):
+class Spec(YAMLObject):
+# base for the small read-only value types below - slotted, compared by value,
+# and never copied since they can't change
+
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, val in zip(self.__slots__, args):
+            object.__setattr__(self, name, val)
+
+    def __setattr__(self, name, val):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __eq__(self, other):
+        if type(other) != type(self):
+            return NotImplemented
+        return self._args() == other._args()
+
+    def __hash__(self):
+        return hash(self._args())
+
+    def __reduce__(self):
+        return type(self), self._args()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _args(self):
+        return tuple(getattr(self, name) for name in self.__slots__[:self._nargs])
+
+    @classmethod
+    def from_yaml(cls, loader, node):
+        value = loader.construct_scalar(node)
+        try:
+            return cls(*cls._parse(value))
+        except (IndexError, ValueError):
+            raise oyaml.constructor.ConstructorError(None, None, "bad %s value '%s'" % (cls.yaml_tag, value), node.start_mark)
+
+    @classmethod
+    def to_yaml(cls, dumper, data):
+        # the same object can appear all over a bank - write it out in full each time
+        # instead of as an anchor and aliases
+        dumper.alias_key = None
+        return dumper.represent_scalar(cls.yaml_tag, str(data))
+
+
+class SFPreset(Spec):
+# identical presets are shared, so a big bank holds one object per distinct preset
 
     yaml_tag = '!sfpreset'
     yaml_loader = oyaml.SafeLoader
     yaml_dumper = oyaml.SafeDumper
+    __slots__ = ('name', 'bank', 'prog', '__weakref__')
+    _nargs = 3
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, name, bank, prog):
+        key = name, bank, prog
+        preset = cls._interned.get(key)
+        if preset == None:
+            preset = super().__new__(cls)
+            Spec.__init__(preset, name, bank, prog)
+            cls._interned[key] = preset
+        return preset
 
     def __init__(self, name, bank, prog):
-        self.name = name
-        self.bank = bank
-        self.prog = prog
-        
+        pass # set up in __new__
+
     def __repr__(self):
         return '%s:%03d:%03d' % (self.name, self.bank, self.prog)
 
-    @classmethod
-    def from_yaml(cls, loader, node):
-        name, bank, prog = sfpex.findall(loader.construct_scalar(node))[0]
-        bank = int(bank)
-        prog = int(prog)
-        return cls(name, bank, prog)
-
     @staticmethod
-    def to_yaml(dumper, data):
-        return dumper.represent_scalar('!sfpreset', str(data))
+    def _parse(value):
+        name, bank, prog = sfpex.findall(value)[0]
+        return name, int(bank), int(prog)
+
 
+class PresetRecord(namedtuple('PresetRecord', 'name bank prog')):
+# compact read-only record for listing the presets in a soundfont
+# dumps to YAML as an SFPreset
 
-class CCMsg(YAMLObject):
+    __slots__ = ()
+
+    def __repr__(self):
+        return '%s:%03d:%03d' % self
+
+
+class CCMsg(Spec):
 
     yaml_tag = '!ccmsg'
     yaml_loader = oyaml.SafeLoader
     yaml_dumper = oyaml.SafeDumper
+    __slots__ = ('chan', 'cc', 'val')
+    _nargs = 3
 
     def __init__(self, chan, cc, val):
-        self.chan = chan
-        self.cc = cc
-        self.val = val
-        
+        super().__init__(chan, cc, val)
+
     def __repr__(self):
         return '%d/%d=%d' % (self.chan, self.cc, self.val)
 
-    @classmethod
-    def from_yaml(cls, loader, node):
-        msg = ccmsgex.findall(loader.construct_scalar(node))[0]
-        chan, cc, val = map(int, msg)
-        return cls(chan, cc, val)
-
     @staticmethod
-    def to_yaml(dumper, data):
-        return dumper.represent_scalar('!ccmsg', str(data))
+    def _parse(value):
+        return map(int, ccmsgex.findall(value)[0])
 
 
-class RouterSpec(YAMLObject):
+class RouterSpec(Spec):
+# vals holds the numeric form, with note names converted, worked out once
 
     yaml_tag = '!rspec'
     yaml_loader = oyaml.SafeLoader
     yaml_dumper = oyaml.SafeDumper
-    
+    __slots__ = ('min', 'max', 'mul', 'add', 'vals')
+    _nargs = 4
+
     def __init__(self, min, max, mul, add):
-        self.min = min
-        self.max = max
-        self.mul = mul
-        self.add = add
+        v = list(map(scinote_to_val, [min, max, mul, add]))
+        super().__init__(min, max, mul, add, (int(v[0]), int(v[1]), float(v[2]), int(v[3])))
 
     def __repr__(self):
         if isinstance(self.add, int):
@@ -102,11 +169,6 @@ class RouterSpec(YAMLObject):
         else:
             return '%s-%s*%s%s' % (self.min, self.max, self.mul, self.add)
         
-    @property
-    def vals(self):
-        v = list(map(scinote_to_val, [self.min, self.max, self.mul, self.add]))
-        return int(v[0]), int(v[1]), float(v[2]), int(v[3])
-        
     @classmethod
     def fromtospec(cls, spec):
         from1, from2, to1, to2 = spec.vals
@@ -114,46 +176,29 @@ class RouterSpec(YAMLObject):
         add = to1 - from1 * mul
         return cls(from1, from2, mul, add)
 
-    @classmethod
-    def from_yaml(cls, loader, node):
-        route = rspecex.findall(loader.construct_scalar(node))[0]
-        min, max, mul, add = map(sift, route)
-        return cls(min, max, mul, add)
-        
     @staticmethod
-    def to_yaml(dumper, data):
-        return dumper.represent_scalar('!rspec', str(data))
+    def _parse(value):
+        return map(sift, rspecex.findall(value)[0])
         
 
-class FromToSpec(YAMLObject):
+class FromToSpec(Spec):
 
     yaml_tag = '!ftspec'
     yaml_loader = oyaml.SafeLoader
     yaml_dumper = oyaml.SafeDumper
+    __slots__ = ('from1', 'from2', 'to1', 'to2', 'vals')
+    _nargs = 4
     
     def __init__(self, from1, from2, to1, to2):
-        self.from1 = from1
-        self.from2 = from2
-        self.to1 = to1
-        self.to2 = to2
+        v = list(map(scinote_to_val, [from1, from2, to1, to2]))
+        super().__init__(from1, from2, to1, to2, (int(v[0]), int(v[1]), float(v[2]), int(v[3])))
         
     def __repr__(self):
-        return '%s-%s=%s-%s' % (data.from1, data.from2, data.to1, data.to2)
-        
-    @property
-    def vals(self):
-        v = list(map(scinote_to_val, [self.from1, self.from2, self.to1, self.to2]))
-        return int(v[0]), int(v[1]), float(v[2]), int(v[3])
-        
-    @classmethod
-    def from_yaml(cls, loader, node):
-        spec = ftspecex.findall(loader.construct_scalar(node))[0]
-        from1, from2, to1, to2 = map(sift, spec)
-        return cls(from1, from2, to1, to2)
-        
+        return '%s-%s=%s-%s' % (self.from1, self.from2, self.to1, self.to2)
+
     @staticmethod
-    def to_yaml(dumper, data):
-        return dumper.represent_scalar('!ftspec', str(data))
+    def _parse(value):
+        return map(sift, ftspecex.findall(value)[0])
 
 
 class FlowSeq(YAMLObject):
@@ -208,20 +253,136 @@ class FlowMap(YAMLObject):
         return dumper.represent_mapping('!flowmap', data, flow_style=True)
 
 
-handlers = dict(Loader=oyaml.SafeLoader, Dumper=oyaml.SafeDumper)
+class LazyPatches(MutableMapping):
+# the patches in a bank, kept as parsed YAML nodes and only constructed when used
+# the most recently used ones are kept in a cache of :cachesize patches, and
+# patches that are added or pinned for editing stay constructed
+
+    def __init__(self, nodes, loader, cachesize):
+        self._nodes = nodes
+        self._loader = loader
+        self._cachesize = cachesize
+        self._cache = OrderedDict()
+        self._pinned = {}
+
+    def __getitem__(self, name):
+        if name in self._pinned:
+            return self._pinned[name]
+        if name in self._cache:
+            self._cache.move_to_end(name)
+            return self._cache[name]
+        patch = self._loader.construct_document(self._nodes[name])
+        self._cache[name] = patch
+        if len(self._cache) > self._cachesize:
+            self._cache.popitem(last=False)
+        return patch
+
+    def __setitem__(self, name, patch):
+        if name not in self._nodes:
+            self._nodes[name] = None
+        self._cache.pop(name, None)
+        self._pinned[name] = patch
+
+    def __delitem__(self, name):
+        del self._nodes[name]
+        self._cache.pop(name, None)
+        self._pinned.pop(name, None)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def pin(self, name):
+    # keep patch :name constructed, so changes to it aren't lost
+        self[name] = self[name]
+
+    def soundfonts(self):
+    # names of the soundfonts used by all patches, without constructing them
+        sfonts = set()
+        for name, node in self._nodes.items():
+            if name in self._pinned or node == None:
+                patch = self[name]
+                sfonts |= {patch[x].name for x in patch if isinstance(x, int)}
+            elif isinstance(node, oyaml.MappingNode):
+                for k, v in node.value:
+                    if k.tag == 'tag:yaml.org,2002:int' and v.tag == '!sfpreset':
+                        sfonts.add(sfpex.findall(v.value)[0][0])
+        return sfonts
+
+    @staticmethod
+    def to_yaml(dumper, data):
+    # patches that were never constructed are written straight from their nodes
+        value = []
+        for name, node in data._nodes.items():
+            if name in data._pinned or name in data._cache:
+                node = dumper.represent_data(data[name])
+            value.append((dumper.represent_data(name), node))
+        return oyaml.MappingNode('tag:yaml.org,2002:map', value)
+
+
+def lazy_load(text, cachesize):
+# parse a bank, leaving the patches as a LazyPatches
+    loader = Loader(text)
+    try:
+        root = loader.get_single_node()
+    finally:
+        loader.dispose()
+    if not isinstance(root, oyaml.MappingNode):
+        return loader.construct_document(root) if root else None
+    bank = {}
+    for k, v in root.value:
+        key = loader.construct_document(k)
+        if key == 'patches' and isinstance(v, oyaml.MappingNode):
+            nodes = {loader.construct_document(pk): pv for pk, pv in v.value}
+            bank[key] = LazyPatches(nodes, loader, cachesize)
+        else:
+            bank[key] = loader.construct_document(v)
+    return bank
+
+def safe_load(text):
+    return oyaml.load(text, Loader=Loader)
+
+def safe_load_all(text):
+    return oyaml.load_all(text, Loader=Loader)
+
+def safe_dump(data):
+    return oyaml.dump(data, Dumper=Dumper)
+
+def safe_dump_all(data):
+    return oyaml.dump_all(data, Dumper=Dumper)
+
+
+# the classes above register themselves with the pure-python SafeLoader/SafeDumper,
+# the libyaml versions get the same constructors and representers here
+handlers = [dict(Loader=oyaml.SafeLoader, Dumper=oyaml.SafeDumper)]
+if Loader != oyaml.SafeLoader:
+    handlers.append(dict(Loader=Loader, Dumper=Dumper))
+    for cls in (SFPreset, CCMsg, RouterSpec, FromToSpec, FlowSeq, FlowMap):
+        Loader.add_constructor(cls.yaml_tag, cls.from_yaml)
+        Dumper.add_representer(cls, cls.to_yaml)
 
-oyaml.add_implicit_resolver('!sfpreset', sfpex, **handlers)
-oyaml.add_implicit_resolver('!ccmsg', ccmsgex, **handlers)
-oyaml.add_implicit_resolver('!rspec', rspecex, **handlers)
-oyaml.add_implicit_resolver('!ftspec', ftspecex, **handlers)
+for h in handlers:
+    oyaml.add_representer(PresetRecord, SFPreset.to_yaml, Dumper=h['Dumper'])
+    oyaml.add_representer(LazyPatches, LazyPatches.to_yaml, Dumper=h['Dumper'])
+    oyaml.add_implicit_resolver('!sfpreset', sfpex, **h)
+    oyaml.add_implicit_resolver('!ccmsg', ccmsgex, **h)
+    oyaml.add_implicit_resolver('!rspec', rspecex, **h)
+    oyaml.add_implicit_resolver('!ftspec', ftspecex, **h)
 
 def resolve_as_flowmap(*path):
     pathkeys = list(zip(path[::2], path[1::2]))
-    oyaml.add_path_resolver('!flowmap', pathkeys, kind=dict, **handlers)
+    for h in handlers:
+        oyaml.add_path_resolver('!flowmap', pathkeys, kind=dict, **h)
     
 def resolve_as_flowseq(*path):
     pathkeys = list(zip(path[::2], path[1::2]))
-    oyaml.add_path_resolver('!flowseq', pathkeys, kind=list, **handlers)
+    for h in handlers:
+        oyaml.add_path_resolver('!flowseq', pathkeys, kind=list, **h)
 
 snode = oyaml.SequenceNode
 mnode = oyaml.MappingNode
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Description: per-patch CPU cost profiler for patcher
+    renders a stress phrase (sustained pad, chords, drum fill) through every
+    patch in a bank offline, one audio period at a time, and ranks the patches
+    by the worst time taken to render a period; also reports the average load,
+    peak polyphony, and the extra load of each patch's LADSPA effects
+    run it on the device the bank will be played on, with the same config
+"""
+import sys, argparse
+import mido
+import patcher
+
+PAD = [48, 52, 55, 59, 62]
+CHORDS = [[60, 64, 67, 71, 74, 77], [62, 65, 69, 72, 76, 79], [64, 67, 71, 74, 77, 81], [65, 69, 72, 76, 79, 83]]
+DRUMS = [36, 38, 42, 38, 36, 45, 47, 48, 50, 38, 49, 57]
+
+class Profile:
+# collects render statistics for one patch
+
+    def __init__(self, pxr, period):
+        self.pxr = pxr
+        self.period = period
+        self.frames = 0
+        self.time = 0.0
+        self.worst = 0.0
+        self.voices = 0
+
+    def block(self, nframes, seconds):
+        self.frames += nframes
+        self.time += seconds
+        if nframes == self.period:
+            # shorter blocks are cut at MIDI messages and would skew the worst case
+            self.worst = max(self.worst, seconds)
+        self.voices = max(self.voices, self.pxr.active_voices())
+
+def stress_phrase(channel=0, drumchannel=9):
+# a list of mido messages with times in seconds since the previous one
+    events = []
+    def note(t, length, chan, key, vel):
+        events.append((t, mido.Message('note_on', channel=chan, note=key, velocity=vel)))
+        events.append((t + length, mido.Message('note_off', channel=chan, note=key)))
+    # sustained pad held with the sustain pedal
+    events.append((0.0, mido.Message('control_change', channel=channel, control=64, value=127)))
+    for key in PAD:
+        note(0.0, 0.5, channel, key, 90)
+    events.append((6.0, mido.Message('control_change', channel=channel, control=64, value=0)))
+    # repeated chords on top
+    for i in range(16):
+        for key in CHORDS[i % len(CHORDS)]:
+            note(1.0 + i * 0.25, 0.2, channel, key, 70 + i * 3)
+    # a fast drum fill, with crashes at the end
+    for i in range(24):
+        note(3.0 + i * 0.083, 0.05, drumchannel, DRUMS[i % len(DRUMS)], 60 + i * 2)
+    note(5.0, 0.5, drumchannel, 49, 127)
+    note(5.0, 0.5, drumchannel, 57, 127)
+    events.sort(key=lambda e: e[0])
+    msgs, last = [], 0.0
+    for t, msg in events:
+        msgs.append(msg.copy(time=t - last))
+        last = t
+    return msgs
+
+def profile_patch(pxr, patch, phrase, period, noeffects=False):
+# render :phrase through :patch, or with :noeffects through the patch without its effects
+# returns a Profile, or None with :noeffects if the patch has no effects
+    pxr.select_patch(patch)
+    if noeffects and not pxr.fxchain_clear():
+        return None
+    p = Profile(pxr, period)
+    pxr.render(phrase, tail=2.0, block=period, blockfunc=p.block)
+    return p
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].split(': ', 1)[1])
+    parser.add_argument('bank', help="bank file, relative to bankdir")
+    parser.add_argument('-c', '--config', default='SquishBox/squishboxconf.yaml', help="patcher config file")
+    parser.add_argument('-p', '--period', type=int, help="audio period size in frames (default: audio.period-size from the config)")
+    args = parser.parse_args()
+
+    pxr = patcher.Patcher(args.config, offline=True)
+    try:
+        pxr.load_bank(args.bank)
+    except patcher.PatcherError as e:
+        sys.exit(e)
+    rate = pxr.fluid_get('synth.sample-rate')
+    period = args.period or pxr.cfg.get('fluidsettings', {}).get('audio.period-size', 64)
+    budget = period / rate
+    phrase = stress_phrase()
+
+    results = []
+    for name in pxr.patch_names():
+        p = profile_patch(pxr, name, phrase, period)
+        dry = profile_patch(pxr, name, phrase, period, noeffects=True)
+        fxload = (p.time - dry.time) / (p.frames / rate) if dry else None
+        results.append((p.worst / budget, p.time / (p.frames / rate), p.voices, fxload, name))
+
+    print("%s: period %d frames at %d Hz (%.2f ms)" % (args.bank, period, rate, budget * 1000))
+    print("  %-24s %10s %9s %7s %8s" % ('patch', 'worst/per', 'avg load', 'voices', 'fx load'))
+    for worst, load, voices, fxload, name in sorted(results, reverse=True):
+        fx = '%7.1f%%' % (fxload * 100) if fxload != None else '%8s' % '-'
+        warn = '  XRUN RISK' if worst >= 1 else ''
+        print("  %-24s %9.1f%% %8.1f%% %7d %s%s" % (name[:24], worst * 100, load * 100, voices, fx, warn))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Description: renders MIDI files through the patches of a bank offline
+    plays a MIDI file through each of the given patches (default: all patches
+    in the bank) without an audio device, as fast as the CPU allows, and writes
+    the audio to 32-bit float WAV files named <midifile>-<patch>.wav
+"""
+import os, re, sys, time, argparse
+import patcher
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].split(': ', 1)[1])
+    parser.add_argument('bank', help="bank file, relative to bankdir")
+    parser.add_argument('midifile', help="MIDI file to play")
+    parser.add_argument('-p', '--patch', action='append', help="patch name or number to render, can be repeated")
+    parser.add_argument('-o', '--outdir', default='.', help="directory for the WAV files")
+    parser.add_argument('-t', '--tail', type=float, default=2.0, help="seconds to keep rendering after the last message")
+    parser.add_argument('-c', '--config', default='SquishBox/squishboxconf.yaml', help="patcher config file")
+    args = parser.parse_args()
+
+    pxr = patcher.Patcher(args.config, offline=True)
+    try:
+        pxr.load_bank(args.bank)
+    except patcher.PatcherError as e:
+        sys.exit(e)
+    patches = args.patch or pxr.patch_names()
+    base = os.path.splitext(os.path.basename(args.midifile))[0]
+    os.makedirs(args.outdir, exist_ok=True)
+    rate = pxr.fluid_get('synth.sample-rate')
+    for patch in patches:
+        if patch.isdigit():
+            patch = pxr.patch_name(int(patch) - 1)
+        wavfile = os.path.join(args.outdir, '%s-%s.wav' % (base, re.sub(r'[^\w\-]+', '_', patch)))
+        t = time.perf_counter()
+        audio = pxr.render(args.midifile, wavfile, patch=patch, tail=args.tail)
+        t = time.perf_counter() - t
+        seconds = len(audio) / 2 / rate
+        print("%s: %.1f s of audio in %.2f s (%.0fx realtime)" % (wavfile, seconds, t, seconds / max(t, 1e-9)))
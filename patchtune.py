@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Description: audio buffer autotuner for patcher
+    finds the patch in a bank that takes longest to render, then renders the
+    stress phrase from patchprofile.py through it offline for each candidate
+    audio.period-size and synth.cpu-cores, and writes the smallest period size
+    whose worst render time fits safely within a period, along with a matching
+    audio.periods and synth.cpu-cores, to the config file
+    run it on the device the config is for, with nothing else playing
+"""
+import os, re, argparse, multiprocessing
+import patcher
+from patchprofile import stress_phrase, profile_patch
+
+PERIOD_SIZES = [32, 64, 128, 256, 512, 1024]
+MAX_CORES = 4
+# share of a period the worst render may take, and below which two periods are enough
+SAFE_LOAD = 0.7
+TWO_PERIOD_LOAD = 0.5
+
+def heaviest_patch(config, bank, period):
+    pxr = patcher.Patcher(config, offline=True)
+    pxr.load_bank(bank)
+    phrase = stress_phrase()
+    worst = {name: profile_patch(pxr, name, phrase, period).worst for name in pxr.patch_names()}
+    return max(worst, key=worst.get), pxr.fluid_get('synth.sample-rate')
+
+def worst_periods(config, bank, patch, cores, sizes):
+# worst time to render a period of each size, with :cores synthesis threads
+    pxr = patcher.Patcher(config, {'synth.cpu-cores': cores}, offline=True)
+    pxr.load_bank(bank)
+    phrase = stress_phrase()
+    return {size: profile_patch(pxr, patch, phrase, size).worst for size in sizes}
+
+def in_subprocess(func, *args):
+# each synth gets a fresh process, so soundfonts are freed and runs don't disturb each other
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args)
+
+def set_fluidsettings(raw, settings):
+# change or add :settings in a block-style fluidsettings section of the config text, keeping comments
+    for opt, val in settings.items():
+        line = re.compile(r'^(\s+%s:)[ \t]*[^\s#]*' % re.escape(opt), re.M)
+        section = re.search(r'^fluidsettings:.*\n(\s+)?', raw, re.M)
+        if line.search(raw):
+            raw = line.sub(lambda m: '%s %s' % (m[1], val), raw, count=1)
+        elif section:
+            indent = section[1] or '  '
+            raw = raw[:section.start(1)] + '%s%s: %s\n' % (indent, opt, val) + raw[section.start(1):]
+        else:
+            raw = raw.rstrip('\n') + '\nfluidsettings:\n  %s: %s\n' % (opt, val)
+    return raw
+
+def save_fluidsettings(cfgfile, settings):
+# write :settings to the config file, editing the text so comments are kept if the result
+# reads back as the same config with the new settings, otherwise writing the config out anew
+    with open(cfgfile) as f:
+        raw = f.read()
+    cfg = patcher.read_yaml(raw)
+    cfg['fluidsettings'] = {**cfg.get('fluidsettings', {}), **settings}
+    try:
+        text = set_fluidsettings(raw, settings)
+        if patcher.read_yaml(text) != cfg:
+            text = None
+    except patcher.yamlext.YAMLError:
+        text = None
+    with open(cfgfile, 'w') as f:
+        f.write(text or patcher.write_yaml(cfg))
+    return text != None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].split(': ', 1)[1])
+    parser.add_argument('bank', nargs='?', help="bank file, relative to bankdir (default: currentbank from the config)")
+    parser.add_argument('-c', '--config', default='SquishBox/squishboxconf.yaml', help="patcher config file")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="only print the results, don't change the config")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = patcher.read_yaml(f.read())
+    bank = args.bank or cfg.get('currentbank')
+    period = cfg.get('fluidsettings', {}).get('audio.period-size', 64)
+    patch, rate = in_subprocess(heaviest_patch, args.config, bank, period)
+    print("heaviest patch in %s: %s" % (bank, patch))
+
+    candidates = []
+    for cores in range(1, min(os.cpu_count() or 1, MAX_CORES) + 1):
+        worst = in_subprocess(worst_periods, args.config, bank, patch, cores, PERIOD_SIZES)
+        for size in PERIOD_SIZES:
+            load = worst[size] / (size / rate)
+            print("  cpu-cores %d, period-size %4d: worst period %5.1f%%" % (cores, size, load * 100))
+            candidates.append((load > SAFE_LOAD, size, cores, load))
+    unsafe, size, cores, load = min(candidates)
+    if unsafe:
+        size, cores, load = min((c for c in candidates if c[1] == PERIOD_SIZES[-1]), key=lambda c: c[3])[1:]
+        print("no period size renders safely - using the largest")
+    periods = 2 if load <= TWO_PERIOD_LOAD else 3
+    settings = {'audio.period-size': size, 'audio.periods': periods, 'synth.cpu-cores': cores}
+    print("%s (%.1f ms latency)" % (', '.join('%s: %s' % x for x in settings.items()), size * periods / rate * 1000))
+
+    if not args.dry_run:
+        if save_fluidsettings(args.config, settings):
+            print("saved to %s" % args.config)
+        else:
+            print("saved to %s (rewritten without comments, couldn't edit it in place)" % args.config)
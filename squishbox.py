@@ -42,7 +42,7 @@ def load_bank_menu():
         return False
     sb.lcd_write('loading patches ', 1)
     try:
-        pxr.load_bank(banks[i])
+        pxr.load_bank(banks[i], background=True)
     except patcher.PatcherError:
         sb.lcd_write('bank load error!', 1)
         sb.waitforrelease(2)
@@ -97,6 +97,7 @@ except patcher.PatcherError:
             break
 pno = 0
 warn = pxr.select_patch(pno)
+sfloading = None
 networks = []
 
 fxmenu_info = (
@@ -140,6 +141,14 @@ while True:
         sb.update()
         pxr.poll_cc()
 
+        # show progress of soundfonts loading in the background
+        if sfloading != pxr.sfloading:
+            sfloading = pxr.sfloading
+            if sfloading:
+                sb.lcd_write(SB.LINESTR % ('loading sf %d/%d' % sfloading), 1)
+            else:
+                break
+
         # patch/preset switching
         if SB.TAP in sb.buttons():
             if warn:
@@ -360,7 +369,7 @@ while True:
             sb.lcd_clear()
             sb.lcd_blink('Reloading Bank  ', row=0)
             lastpatch = pxr.patch_name(pno)
-            pxr.load_bank(pxr.currentbank)
+            pxr.load_bank(pxr.currentbank, background=True, firstpatch=lastpatch)
             try:
                 pno = pxr.patch_index(lastpatch)
             except patcher.PatcherError:
@@ -404,9 +413,9 @@ while True:
                 sb.lcd_write('loading patches ', 1)
                 try:
                     if req.body == '':
-                        rawbank = pxr.load_bank()
+                        rawbank = pxr.load_bank(background=True)
                     else:
-                        rawbank = pxr.load_bank(req.body)
+                        rawbank = pxr.load_bank(req.body, background=True)
                 except patcher.PatcherError as e:
                     remote_link.reply(req, str(e), netlink.REQ_ERROR)
                     sb.lcd_write('bank load error!', 1)
@@ -455,6 +464,13 @@ while True:
                 else:
                     remote_link.reply(req, patcher.write_yaml(pxr.sfpresets))
 
+            elif req.type == netlink.LIST_SFPRESETS:
+                presets = pxr.list_sfpresets(req.body)
+                if not presets:
+                    remote_link.reply(req, 'Unable to read %s' % req.body, netlink.REQ_ERROR)
+                else:
+                    remote_link.reply(req, patcher.write_yaml(presets))
+
             elif req.type == netlink.SELECT_SFPRESET:
                 pno = int(req.body)
                 warn = pxr.select_sfpreset(pno)
@@ -462,6 +462,13 @@ def squishpatch():
                     else:
                         remote_link.reply(req, patcher.write_yaml(pxr.sfpresets))
 
+                elif req.type == netlink.LIST_SFPRESETS:
+                    presets = pxr.list_sfpresets(req.body)
+                    if not presets:
+                        remote_link.reply(req, 'Unable to read %s' % req.body, netlink.REQ_ERROR)
+                    else:
+                        remote_link.reply(req, patcher.write_yaml(presets))
+
                 elif req.type == netlink.SELECT_SFPRESET:
                     pno = int(req.body)
                     warn = pxr.select_sfpreset(pno)
@@ -22,6 +22,7 @@ LIST_PLUGINS = 20
 LIST_PORTS = 21
 READ_CFG = 22
 SAVE_CFG = 23
+LIST_SFPRESETS = 24
 # to be implemented(?):
 # SOFTWARE_UPDATE
 